@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import sys
+import time
+import dbus
+import queue
+import multiprocessing
+
+
+duration = 10
+slowClientCount = 4
+fastClientCount = 4
+
+
+def slowClient(stopEvent, networkName):
+    # keeps the daemon busy with tap interface creation and deletion
+    dbusObj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService')
+    while not stopEvent.is_set():
+        sid = dbusObj.NewVmResSet(dbus_interface='org.fpemud.VirtService')
+        obj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService/%d/VmResSets/%d' % (os.getuid(), sid))
+        obj.AddTapIntf(networkName, dbus_interface='org.fpemud.VirtService.VmResSet')
+        obj.RemoveTapIntf(dbus_interface='org.fpemud.VirtService.VmResSet')
+        dbusObj.DeleteVmResSet(sid, dbus_interface='org.fpemud.VirtService')
+
+
+def fastClient(stopEvent, resultQueue):
+    # measures the latency of a method that needs no slow operation
+    # the tap interface is created before measuring, GetTapIntf() fails on a resource set without it
+    # None is put into resultQueue if anything fails, so that runBench() doesn't wait for the result forever
+    latencyList = None
+    try:
+        dbusObj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService')
+        sid = dbusObj.NewVmResSet(dbus_interface='org.fpemud.VirtService')
+        obj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService/%d/VmResSets/%d' % (os.getuid(), sid))
+        try:
+            obj.AddTapIntf("nat", dbus_interface='org.fpemud.VirtService.VmResSet')
+
+            latencyList = []
+            while not stopEvent.is_set():
+                t = time.time()
+                obj.GetTapIntf(dbus_interface='org.fpemud.VirtService.VmResSet')
+                latencyList.append(time.time() - t)
+                time.sleep(0.01)
+        finally:
+            dbusObj.DeleteVmResSet(sid, dbus_interface='org.fpemud.VirtService')
+    finally:
+        resultQueue.put(latencyList)
+
+
+def runBench(slowCount):
+    stopEvent = multiprocessing.Event()
+    resultQueue = multiprocessing.Queue()
+
+    procList = []
+    for i in range(0, slowCount):
+        networkName = "nat" if i % 2 == 0 else "bridge"
+        procList.append(multiprocessing.Process(target=slowClient, args=(stopEvent, networkName)))
+    for i in range(0, fastClientCount):
+        procList.append(multiprocessing.Process(target=fastClient, args=(stopEvent, resultQueue)))
+    for p in procList:
+        p.start()
+
+    time.sleep(duration)
+    stopEvent.set()
+
+    latencyList = []
+    failCount = 0
+    for i in range(0, fastClientCount):
+        try:
+            ret = resultQueue.get(timeout=60)
+        except queue.Empty:
+            failCount = fastClientCount - i           # the remaining clients hang or die without a result
+            break
+        if ret is None:
+            failCount += 1
+        else:
+            latencyList += ret
+    for p in procList:
+        p.join(60)
+        if p.is_alive():
+            p.terminate()
+            p.join()
+    if failCount > 0:
+        print("%d fast clients failed" % (failCount))
+
+    latencyList.sort()
+    return latencyList
+
+
+def printResult(name, latencyList):
+    if len(latencyList) == 0:
+        print("%-20s no call completed" % (name))
+        return
+    p50 = latencyList[len(latencyList) // 2]
+    p99 = latencyList[len(latencyList) * 99 // 100]
+    print("%-20s calls: %6d    p50: %8.3f ms    p99: %8.3f ms    max: %8.3f ms" % (name, len(latencyList), p50 * 1000, p99 * 1000, latencyList[-1] * 1000))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        duration = int(sys.argv[1])
+
+    printResult("idle", runBench(0))
+    printResult("%d slow clients" % (slowClientCount), runBench(slowClientCount))
@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import sys
+import fcntl
+import time
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from virt_util import VirtUtil                # noqa: E402
+
+
+count = 100
+prefix = "vnbbench"
+
+
+def benchIpTuntap():
+    t = time.time()
+    for i in range(0, count):
+        ret = subprocess.Popen('/bin/ip tuntap add dev "%s.%d" mode tap' % (prefix, i), shell=True).wait()
+        assert ret == 0
+    tAdd = time.time() - t
+
+    t = time.time()
+    for i in range(0, count):
+        ret = subprocess.Popen('/bin/ip tuntap del dev "%s.%d" mode tap' % (prefix, i), shell=True).wait()
+        assert ret == 0
+    tDel = time.time() - t
+
+    return (tAdd, tDel)
+
+
+def benchTunSetIff():
+    t = time.time()
+    for i in range(0, count):
+        VirtUtil.createTapInterface("%s.%d" % (prefix, i), 0, 0)
+    tAdd = time.time() - t
+
+    t = time.time()
+    for i in range(0, count):
+        deleteTapInterface("%s.%d" % (prefix, i))
+    tDel = time.time() - t
+
+    return (tAdd, tDel)
+
+
+def deleteTapInterface(ifname):
+    # the tap interfaces are deleted through netlink by virt-service, this is the TUNSETIFF counterpart
+    fd = os.open("/dev/net/tun", os.O_RDWR)
+    try:
+        fcntl.ioctl(fd, 0x400454ca, VirtUtil._tapIfReq(ifname, False, False))     # TUNSETIFF
+        fcntl.ioctl(fd, 0x400454cb, 0)                                          # TUNSETPERSIST
+    finally:
+        os.close(fd)
+
+
+def printResult(name, result):
+    print("%-20s add: %8.3f ms/tap    del: %8.3f ms/tap" % (name, result[0] * 1000 / count, result[1] * 1000 / count))
+
+
+if __name__ == "__main__":
+    assert os.path.exists("/bin/ip")
+    assert os.getuid() == 0
+
+    printResult("ip tuntap", benchIpTuntap())
+    printResult("TUNSETIFF", benchTunSetIff())
@@ -136,6 +136,11 @@ if __name__ == "__main__":
         ret = subprocess.Popen('/bin/rm -rf /tmp/virt-service', shell=True).wait()
         assert ret == 0
 
+    if os.path.exists("/run/virt-service"):
+        print("Removing directory /run/virt-service")
+        ret = subprocess.Popen('/bin/rm -rf /run/virt-service', shell=True).wait()
+        assert ret == 0
+
     if readFile("/proc/sys/net/ipv4/ip_forward").strip() != "0":
         print("Resetting /proc/sys/net/ipv4/ip_forward")
         writeFile("/proc/sys/net/ipv4/ip_forward", "0")
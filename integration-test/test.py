@@ -4,6 +4,8 @@
 import os
 import re
 import dbus
+import time
+import signal
 import subprocess
 import unittest
 
@@ -55,6 +57,88 @@ class Test_ResSet_TapIntfNat(unittest.TestCase):
         pass
 
 
+class Test_ResSet_TapIntfOptions(unittest.TestCase):
+
+    def setUp(self):
+        self.dbusObj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService')
+        self.uid = os.getuid()
+
+    def runTest(self):
+        sid = self.dbusObj.NewVmResSet(dbus_interface='org.fpemud.VirtService')
+        obj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService/%d/VmResSets/%d' % (self.uid, sid))
+
+        options = {"queues": dbus.Int32(4), "vnet_hdr": True, "offloads": dbus.Array(["csum", "tso4"], signature='s')}
+        obj.AddTapIntfWithOptions("nat", options, dbus_interface='org.fpemud.VirtService.VmResSet')
+
+        self.assertTrue(_intfExists("vnb1.1"))
+        self.assertTrue("multi_queue" in _getTunInfo("vnb1.1"))
+        self.assertTrue("vnet_hdr on" in _getTunInfo("vnb1.1"))
+
+        ret = obj.GetTapIntfOptions(dbus_interface='org.fpemud.VirtService.VmResSet')
+        self.assertEqual(ret["queues"], 4)
+        self.assertEqual(ret["vnet_hdr"], True)
+        self.assertEqual(list(ret["offloads"]), ["csum", "tso4"])
+
+        obj.RemoveTapIntf(dbus_interface='org.fpemud.VirtService.VmResSet')
+        self.assertFalse(_intfExists("vnb1.1"))
+
+        self.dbusObj.DeleteVmResSet(sid, dbus_interface='org.fpemud.VirtService')
+
+    def tearDown(self):
+        pass
+
+
+class Test_ResSet_TapIntfFds(unittest.TestCase):
+
+    def setUp(self):
+        self.dbusObj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService')
+        self.uid = os.getuid()
+
+    def runTest(self):
+        sid = self.dbusObj.NewVmResSet(dbus_interface='org.fpemud.VirtService')
+        obj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService/%d/VmResSets/%d' % (self.uid, sid))
+        obj.AddTapIntfWithOptions("nat", {"queues": dbus.Int32(2)}, dbus_interface='org.fpemud.VirtService.VmResSet')
+
+        fdList = [x.take() for x in obj.GetTapIntfFds(dbus_interface='org.fpemud.VirtService.VmResSet')]
+        self.assertEqual(len(fdList), 2)
+        self.assertTrue("numqueues 2" in _getTunInfo("vnb1.1"))
+        for fd in fdList:
+            os.close(fd)
+
+        obj.RemoveTapIntf(dbus_interface='org.fpemud.VirtService.VmResSet')
+        self.dbusObj.DeleteVmResSet(sid, dbus_interface='org.fpemud.VirtService')
+
+    def tearDown(self):
+        pass
+
+
+class Test_ResSet_Bulk(unittest.TestCase):
+
+    def setUp(self):
+        self.dbusObj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService')
+        self.uid = os.getuid()
+
+    def runTest(self):
+        ret = self.dbusObj.NewVmResSets(3, "nat", dbus_interface='org.fpemud.VirtService')
+
+        self.assertEqual(len(ret), 3)
+        self.assertEqual([x[0] for x in ret], [1, 2, 3])
+        self.assertEqual([x[1] for x in ret], ["vnb1.1", "vnb1.2", "vnb1.3"])
+        self.assertEqual([x[3] for x in ret], ["10.0.1.12", "10.0.1.13", "10.0.1.14"])
+        for sid, tapname, macaddr, ipaddr in ret:
+            obj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService/%d/VmResSets/%d' % (self.uid, sid))
+            self.assertTrue(_intfExists(tapname))
+            self.assertEqual(obj.GetTapIntf(dbus_interface='org.fpemud.VirtService.VmResSet'), tapname)
+            self.assertEqual(obj.GetVmMacAddr(dbus_interface='org.fpemud.VirtService.VmResSet'), macaddr)
+
+        for sid, tapname, macaddr, ipaddr in ret:
+            self.dbusObj.DeleteVmResSet(sid, dbus_interface='org.fpemud.VirtService')
+        self.assertFalse(_intfExists("vnb1"))
+
+    def tearDown(self):
+        pass
+
+
 class Test_ResSet_SambaShare(unittest.TestCase):
 
     def setUp(self):
@@ -89,6 +173,69 @@ class Test_ResSet_SambaShare(unittest.TestCase):
         pass
 
 
+class Test_ResSet_SambaShares(unittest.TestCase):
+
+    def setUp(self):
+        self.dbusObj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService')
+        self.uid = os.getuid()
+
+    def runTest(self):
+        sid = self.dbusObj.NewVmResSet(dbus_interface='org.fpemud.VirtService')
+        obj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService/%d/VmResSets/%d' % (self.uid, sid))
+        obj.AddTapIntf("nat", dbus_interface='org.fpemud.VirtService.VmResSet')
+
+        shares = [("abc%d" % (i), os.getcwd(), i % 2 == 0) for i in range(0, 20)]
+        ret = obj.NewSambaShares(shares + [("abc0", os.getcwd(), True)], dbus_interface='org.fpemud.VirtService.VmResSet')
+        self.assertEqual(list(ret), [0] * 20 + [1])
+        for i in range(0, 20):
+            self.assertTrue("[abc%d]\n" % (i) in open("/etc/samba/hosts.d/10.0.1.12.conf").read())
+
+        with self.assertRaises(dbus.exceptions.DBusException):
+            obj.NewSambaShares([("def", os.getcwd(), True), ("def2", "relative", True)], dbus_interface='org.fpemud.VirtService.VmResSet')
+        self.assertFalse("[def]\n" in open("/etc/samba/hosts.d/10.0.1.12.conf").read())
+
+        ret = obj.DeleteSambaShares(["abc%d" % (i) for i in range(0, 20)] + ["def"], dbus_interface='org.fpemud.VirtService.VmResSet')
+        self.assertEqual(list(ret), [0] * 20 + [1])
+        self.assertTrue(len(os.listdir("/etc/samba/hosts.d")) == 0)
+
+        obj.RemoveTapIntf(dbus_interface='org.fpemud.VirtService.VmResSet')
+        self.dbusObj.DeleteVmResSet(sid, dbus_interface='org.fpemud.VirtService')
+
+    def tearDown(self):
+        pass
+
+
+class Test_ResSet_VirtiofsShare(unittest.TestCase):
+
+    def setUp(self):
+        self.dbusObj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService')
+        self.uid = os.getuid()
+
+    def runTest(self):
+        sid = self.dbusObj.NewVmResSet(dbus_interface='org.fpemud.VirtService')
+        obj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService/%d/VmResSets/%d' % (self.uid, sid))
+        obj.AddTapIntf("nat", dbus_interface='org.fpemud.VirtService.VmResSet')
+
+        path = obj.NewVirtiofsShare("abc", os.getcwd(), {"cache": "always", "thread_pool_size": dbus.Int32(4)}, dbus_interface='org.fpemud.VirtService.VmResSet')
+        self.assertTrue(os.path.exists(path))
+        with self.assertRaises(dbus.exceptions.DBusException):
+            obj.NewVirtiofsShare("abc", os.getcwd(), {}, dbus_interface='org.fpemud.VirtService.VmResSet')
+
+        obj.DeleteVirtiofsShare("abc", dbus_interface='org.fpemud.VirtService.VmResSet')
+        self.assertFalse(os.path.exists(path))
+
+        # shares are deleted together with the tap interface
+        path = obj.NewVirtiofsShare("abc2", os.getcwd(), {}, dbus_interface='org.fpemud.VirtService.VmResSet')
+        self.assertTrue(os.path.exists(path))
+        obj.RemoveTapIntf(dbus_interface='org.fpemud.VirtService.VmResSet')
+        self.assertFalse(os.path.exists(path))
+
+        self.dbusObj.DeleteVmResSet(sid, dbus_interface='org.fpemud.VirtService')
+
+    def tearDown(self):
+        pass
+
+
 class Test_ResSet_MultiInstance(unittest.TestCase):
 
     def setUp(self):
@@ -168,6 +315,151 @@ class Test_ResSet_MultiInstance(unittest.TestCase):
         pass
 
 
+class Test_ResSet_Restart(unittest.TestCase):
+
+    def setUp(self):
+        if os.getuid() != 0:
+            self.skipTest("root is needed to kill virt-service")
+        self.dbusObj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService')
+        self.uid = os.getuid()
+
+    def runTest(self):
+        sid = self.dbusObj.NewVmResSet(dbus_interface='org.fpemud.VirtService')
+        obj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService/%d/VmResSets/%d' % (self.uid, sid))
+        obj.AddTapIntf("nat", dbus_interface='org.fpemud.VirtService.VmResSet')
+        obj.NewSambaShare("abc", os.getcwd(), True, dbus_interface='org.fpemud.VirtService.VmResSet')
+
+        brIndex = _fileRead("/sys/class/net/vnb1/ifindex")
+        tapIndex = _fileRead("/sys/class/net/vnb1.1/ifindex")
+
+        _killDaemon()
+
+        # objects are kept after the daemon is gone
+        self.assertEqual(_fileRead("/sys/class/net/vnb1/ifindex"), brIndex)
+        self.assertEqual(_fileRead("/sys/class/net/vnb1.1/ifindex"), tapIndex)
+        self.assertTrue("10.0.1.0/24" in _getNatSubnets())
+        self.assertTrue("[abc]\n" in open("/etc/samba/hosts.d/10.0.1.12.conf").read())
+
+        # the new instance is started by dbus activation, it re-adopts the objects instead of re-creating them
+        self.dbusObj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService')
+        obj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService/%d/VmResSets/%d' % (self.uid, sid))
+        self.assertEqual(obj.GetTapIntf(dbus_interface='org.fpemud.VirtService.VmResSet'), "vnb1.1")
+
+        self.assertEqual(_fileRead("/sys/class/net/vnb1/ifindex"), brIndex)
+        self.assertEqual(_fileRead("/sys/class/net/vnb1.1/ifindex"), tapIndex)
+        self.assertTrue("10.0.1.0/24" in _getNatSubnets())
+        self.assertTrue("[abc]\n" in open("/etc/samba/hosts.d/10.0.1.12.conf").read())
+
+        # the restored resource set is controllable
+        obj.NewSambaShare("abc2", os.getcwd(), True, dbus_interface='org.fpemud.VirtService.VmResSet')
+        self.assertTrue("[abc]\n" in open("/etc/samba/hosts.d/10.0.1.12.conf").read())
+        self.assertTrue("[abc2]\n" in open("/etc/samba/hosts.d/10.0.1.12.conf").read())
+
+        obj.DeleteSambaShares(["abc", "abc2"], dbus_interface='org.fpemud.VirtService.VmResSet')
+        self.assertFalse(os.path.exists("/etc/samba/hosts.d/10.0.1.12.conf"))
+
+        obj.RemoveTapIntf(dbus_interface='org.fpemud.VirtService.VmResSet')
+        self.assertFalse(_intfExists("vnb1"))
+        self.assertFalse(_intfExists("vnb1.1"))
+        self.assertFalse("10.0.1.0/24" in _getNatSubnets())
+
+        self.dbusObj.DeleteVmResSet(sid, dbus_interface='org.fpemud.VirtService')
+
+    def tearDown(self):
+        pass
+
+
+class Test_ResSet_StaleCleanup(unittest.TestCase):
+
+    def setUp(self):
+        if os.getuid() != 0:
+            self.skipTest("root is needed to kill virt-service")
+        self.dbusObj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService')
+        self.uid = os.getuid()
+
+    def runTest(self):
+        sid = self.dbusObj.NewVmResSet(dbus_interface='org.fpemud.VirtService')
+        obj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService/%d/VmResSets/%d' % (self.uid, sid))
+        obj.AddTapIntf("nat", dbus_interface='org.fpemud.VirtService.VmResSet')
+        dnsmasqPid = int(_fileRead("/run/virt-service/dnsmasq.vnb1.pid"))
+
+        _killDaemon()
+
+        # objects which are not recorded in the journal
+        subprocess.check_call("/bin/ip link add vnb99 type bridge", shell=True)
+        with open("/etc/samba/hosts.d/10.0.2.12.conf", "w") as f:
+            f.write("# generated by virt-service, don't edit\n[abc]\n")
+        with open("/etc/samba/hosts.d/10.0.2.13.conf", "w") as f:
+            f.write("[abc]\n")                                 # written by the administrator
+        try:
+            self.dbusObj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService')
+            obj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService/%d/VmResSets/%d' % (self.uid, sid))
+            self.assertEqual(obj.GetTapIntf(dbus_interface='org.fpemud.VirtService.VmResSet'), "vnb1.1")
+
+            self.assertFalse(_intfExists("vnb99"))
+            self.assertFalse(os.path.exists("/etc/samba/hosts.d/10.0.2.12.conf"))
+            self.assertTrue(os.path.exists("/etc/samba/hosts.d/10.0.2.13.conf"))
+
+            # dnsmasq of the restored network is replaced
+            self.assertTrue(_intfExists("vnb1"))
+            self.assertFalse(os.path.exists("/proc/%d" % (dnsmasqPid)))
+            self.assertNotEqual(int(_fileRead("/run/virt-service/dnsmasq.vnb1.pid")), dnsmasqPid)
+        finally:
+            if _intfExists("vnb99"):
+                subprocess.check_call("/bin/ip link del vnb99", shell=True)
+            for fn in ["/etc/samba/hosts.d/10.0.2.12.conf", "/etc/samba/hosts.d/10.0.2.13.conf"]:
+                if os.path.exists(fn):
+                    os.unlink(fn)
+
+        obj.RemoveTapIntf(dbus_interface='org.fpemud.VirtService.VmResSet')
+        self.assertFalse(_intfExists("vnb1"))
+
+        self.dbusObj.DeleteVmResSet(sid, dbus_interface='org.fpemud.VirtService')
+
+    def tearDown(self):
+        pass
+
+
+class Test_ResSet_SambaPerNetwork(unittest.TestCase):
+
+    def setUp(self):
+        self.dbusObj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService')
+        self.uid = os.getuid()
+
+    def runTest(self):
+        sid = self.dbusObj.NewVmResSet(dbus_interface='org.fpemud.VirtService')
+        obj = dbus.SystemBus().get_object('org.fpemud.VirtService', '/org/fpemud/VirtService/%d/VmResSets/%d' % (self.uid, sid))
+        obj.AddTapIntf("nat", dbus_interface='org.fpemud.VirtService.VmResSet')
+        obj.NewSambaShare("abc", os.getcwd(), True, dbus_interface='org.fpemud.VirtService.VmResSet')
+        try:
+            if not os.path.exists("/run/virt-service/smbd.vnb1.pid"):
+                self.skipTest("virt-service does not run in per-network samba server mode")
+
+            # the smbd of the network listens on the bridge address, shares are in its own per-host configuration files
+            smbdPid = int(_fileRead("/run/virt-service/smbd.vnb1.pid"))
+            confFile = _getSmbdConfFile(smbdPid)
+            self.assertTrue("interfaces = 10.0.1.1/255.255.255.0\n" in open(confFile).read())
+            self.assertTrue("bind interfaces only = yes\n" in open(confFile).read())
+
+            hostFile = os.path.join(os.path.dirname(confFile), "hosts.d", "10.0.1.12.conf")
+            self.assertTrue("[abc]\n" in open(hostFile).read())
+            self.assertFalse(os.path.exists("/etc/samba/hosts.d/10.0.1.12.conf"))
+
+            obj.DeleteSambaShare("abc", dbus_interface='org.fpemud.VirtService.VmResSet')
+            self.assertFalse(os.path.exists(hostFile))
+            self.assertTrue(os.path.exists("/proc/%d" % (smbdPid)))
+        finally:
+            obj.RemoveTapIntf(dbus_interface='org.fpemud.VirtService.VmResSet')
+            self.dbusObj.DeleteVmResSet(sid, dbus_interface='org.fpemud.VirtService')
+
+        # the smbd is stopped together with the network
+        self.assertFalse(os.path.exists("/run/virt-service/smbd.vnb1.pid"))
+        self.assertFalse(os.path.exists("/proc/%d" % (smbdPid)))
+
+    def tearDown(self):
+        pass
+
+
 class Test_Vm_Basic(unittest.TestCase):
 
     def setUp(self):
@@ -192,8 +484,16 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(Test_ResSet_Basic())
     suite.addTest(Test_ResSet_TapIntfNat())
+    suite.addTest(Test_ResSet_TapIntfOptions())
+    suite.addTest(Test_ResSet_TapIntfFds())
+    suite.addTest(Test_ResSet_Bulk())
     suite.addTest(Test_ResSet_SambaShare())
+    suite.addTest(Test_ResSet_SambaShares())
+    suite.addTest(Test_ResSet_VirtiofsShare())
     suite.addTest(Test_ResSet_MultiInstance())
+    suite.addTest(Test_ResSet_Restart())
+    suite.addTest(Test_ResSet_StaleCleanup())
+    suite.addTest(Test_ResSet_SambaPerNetwork())
     suite.addTest(Test_Vm_Basic())
     return suite
 
@@ -212,6 +512,13 @@ def _intfExists(intfname):
     return re.search("^%s:" % (intfname), out, re.M) is not None
 
 
+def _getTunInfo(intfname):
+    proc = subprocess.Popen("/bin/ip -d link show %s" % (intfname), shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    out = proc.communicate()[0]
+    assert proc.returncode == 0
+    return out
+
+
 def _getSubIntfSet(intfname):
     proc = subprocess.Popen("/bin/ifconfig -a", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     out = proc.communicate()[0]
@@ -226,6 +533,29 @@ def _getSubIntfSet(intfname):
     return ret2
 
 
+def _getNatSubnets():
+    proc = subprocess.Popen("/sbin/nft list set ip virt-service-nat nat-subnets", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    out = proc.communicate()[0]
+    return out if proc.returncode == 0 else ""           # the table is deleted together with the last nat network
+
+
+def _getSmbdConfFile(pid):
+    with open("/proc/%d/cmdline" % (pid), "r") as f:
+        for arg in f.read().split("\0"):
+            if arg.startswith("--configfile="):
+                return arg[len("--configfile="):]
+    assert False
+
+
+def _killDaemon():
+    # the journal is kept, the next method call starts a new instance by dbus activation
+    dbusObj = dbus.SystemBus().get_object('org.freedesktop.DBus', '/org/freedesktop/DBus')
+    pid = dbusObj.GetConnectionUnixProcessID('org.fpemud.VirtService', dbus_interface='org.freedesktop.DBus')
+    os.kill(pid, signal.SIGKILL)
+    while dbusObj.NameHasOwner('org.fpemud.VirtService', dbus_interface='org.freedesktop.DBus'):
+        time.sleep(0.1)
+
+
 def _testWebsite(intfname, website):
     return True  # fixme
 
@@ -3,9 +3,12 @@
 
 import os
 import dbus
+import threading
+import contextlib
 import dbus.service
 from gi.repository import GLib
 from virt_util import VirtUtil
+from virt_network import VirtTapOptions
 
 ################################################################################
 # DBus API Docs
@@ -19,6 +22,8 @@ from virt_util import VirtUtil
 #
 # Methods:
 #   vmResSetId:int        NewVmResSet()
+#   [(vmResSetId:int, tapifname:string, macaddr:string, ipaddr:string)]
+#                         NewVmResSets(count:int, network_name:string)
 #   void                  DeleteVmResSet(vmResSetId:int)
 #   vmId:int              AttachVm(vmName:string, vmResSetId:int)
 #   void                  DetachVm(vmId:int)
@@ -27,7 +32,10 @@ from virt_util import VirtUtil
 #
 # Notes:
 #   each user can have 128 virt-machine resource sets, vmResSetId must be in range [1,128]
+#   NewVmResSets() creates resource sets with tap interface added, it has the same effect as calling
+#   NewVmResSet(), AddTapIntf(), GetTapIntf(), GetVmMacAddr() and GetVmIpAddr() for each resource set
 #   service exits when the last virtual-machine resource set is deleted?
+#   resource sets, tap interfaces and samba shares survive service restart, they are restored from the state journal
 #
 #
 # ==== VmResSet ====
@@ -37,20 +45,48 @@ from virt_util import VirtUtil
 #
 # Methods:
 #   tapifname:string                   GetTapIntf()
+#   options:dict                       GetTapIntfOptions()
+#   fds:unix_fd[]                      GetTapIntfFds()
 #   macaddr:string                     GetVmMacAddr()
 #   ipaddr:string                      GetVmIpAddr()
 #   (devpath:string)                   GetVfioDevInfo(dev_id:int)
 #
 #   void                               AddTapIntf(network_name:string)
+#   void                               AddTapIntfWithOptions(network_name:string, options:dict)
 #   void                               RemoveTapIntf()
 #   void                               NewSambaShare(share_name:string, share_path:string, readonly:boolean)
 #   void                               DeleteSambaShare(share_name:string)
+#   results:int[]                      NewSambaShares(shares:(share_name:string, share_path:string, readonly:boolean)[])
+#   results:int[]                      DeleteSambaShares(share_names:string[])
+#   socket_path:string                 NewVirtiofsShare(share_name:string, share_path:string, options:dict)
+#   void                               DeleteVirtiofsShare(share_name:string)
 #   dev_id:int                         AddVfioDevice(devName:string, vfioType:string)
 #   void                               RemoveDevice(devId:int)
 #
+# Signals:
+#   VmNetworkReady(ipaddr:string, macaddr:string)
+#
 # Notes:
 #   networkName can be: bridge, nat, route, isolate
+#   tap interface options:
+#     queues:int              number of queues, tap interface is created with IFF_MULTI_QUEUE if it is greater than 1, default is 1
+#     vnet_hdr:boolean        create tap interface with IFF_VNET_HDR, default is false
+#     offloads:string[]       offload flags set by TUNSETOFFLOAD, can be: csum, tso4, tso6, tso_ecn, ufo. vnet_hdr is needed
+#   GetTapIntfFds() returns one opened queue file descriptor for each queue of the tap interface,
+#   they can be used directly by "qemu -netdev tap,fds=X:Y:..." without any privilege
 #   vfioType can be: pci, vga, usb
+#   samba shares are only supported on nat and route network, samba is started on the network when the first share is added
+#   NewSambaShares() and DeleteSambaShares() validate all the shares before applying any of them, then apply them as
+#   one samba configuration update, one result code is returned for each share:
+#     0: success
+#     1: NewSambaShares(): share already exists or duplicates a previous one, DeleteSambaShares(): share does not exist
+#   virtiofs share options:
+#     cache:string            cache mode of virtiofsd, can be: auto, always, never, metadata, default is auto
+#     thread_pool_size:int    size of the thread pool of virtiofsd, 0 means no thread pool, default is decided by virtiofsd
+#   NewVirtiofsShare() returns the path of a vhost-user socket, it can be used by
+#   "qemu -chardev socket,id=X,path=Y -device vhost-user-fs-pci,chardev=X,tag=share_name", the socket is only accessible by the user
+#   virtiofs shares need a tap interface, they are deleted together with the tap interface
+#   VmNetworkReady is emitted when the virt-machine gets or renews its DHCP lease, only on nat and route network
 #
 #
 # ==== VirtMachine ====
@@ -87,11 +123,21 @@ class DbusMainObject(dbus.service.Object):
         # for handling client process termination
         self.handle = dbus.SystemBus().add_signal_receiver(self.onNameOwnerChanged, 'NameOwnerChanged', None, None)
 
+        # restore the resource sets of the previous daemon instance
+        if self.param.initError is None:
+            self._restoreResSets()
+
     def release(self):
         # nothing to do if len(self.resSetDict) > 0 or len(self.vmDict) > 0
         dbus.SystemBus().remove_signal_receiver(self.handle)
         self.remove_from_connection()
 
+    def onVmNetworkReady(self, uid, sid, ip, mac):
+        # called by dhcp server in main loop
+        resset = self.resSetDict.get(uid, dict()).get(sid, None)
+        if resset is not None and resset.networkName is not None and not resset.releasing:
+            resset.VmNetworkReady(ip, mac)
+
     def onNameOwnerChanged(self, name, old, new):
         # focus on name deletion, filter other circumstance
         if not name.startswith(":") or new != "":
@@ -103,14 +149,10 @@ class DbusMainObject(dbus.service.Object):
                 if vm.owner == old:
                     self._vmRemove(vm.uid, vm.vmid, vm)
 
-        for ressetu in self.resSetDict.values():
-            for resset in ressetu.values():
-                if resset.owner == old:
-                    self._resSetRemove(resset.uid, resset.sid, resset)
-
-        # add timeout
-        if len(self.resSetDict) == 0 and self.param.timeoutHandler is None:
-            self.param.timeoutHandler = GLib.timeout_add_seconds(self.param.timeout, lambda *args: self.param.mainloop.quit())
+        for ressetu in list(self.resSetDict.values()):
+            for resset in list(ressetu.values()):
+                if resset.owner == old and not resset.releasing:
+                    self._resSetRemove(resset.uid, resset.sid, resset, lambda: None, lambda e: None)
 
     @dbus.service.method('org.fpemud.VirtService', sender_keyword='sender', out_signature='i')
     def NewVmResSet(self, sender=None):
@@ -128,6 +170,7 @@ class DbusMainObject(dbus.service.Object):
 
             sObj = DbusResSetObject(self.param, uid, sid, sender)
             self.resSetDict[uid][sid] = sObj
+            self.param.journal.add("resset", uid=uid, sid=sid, owner=str(sender))
         except:
             if len(self.resSetDict[uid]) == 0:
                 del self.resSetDict[uid]
@@ -140,25 +183,81 @@ class DbusMainObject(dbus.service.Object):
 
         return sid
 
-    @dbus.service.method('org.fpemud.VirtService', sender_keyword='sender', in_signature='i')
-    def DeleteVmResSet(self, sid, sender=None):
+    @dbus.service.method('org.fpemud.VirtService', sender_keyword='sender', in_signature='is', out_signature='a(isss)',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def NewVmResSets(self, count, network_name, sender=None, reply_handler=None, error_handler=None):
+        self._checkInitError()
+        uid = VirtUtil.dbusGetUserId(self.connection, sender)
+
+        if count <= 0:
+            raise VirtServiceException("invalid virt-machine resource set count")
+
+        # create new resource set objects
+        sObjList = []
+        if uid not in self.resSetDict:
+            self.resSetDict[uid] = dict()
+        try:
+            for i in range(0, count):
+                sid = VirtUtil.allocId(self.resSetDict[uid])
+                if sid > 128:
+                    raise VirtServiceException("too many virt-machine resource set allocated")
+
+                sObj = DbusResSetObject(self.param, uid, sid, sender)
+                self.resSetDict[uid][sid] = sObj
+                sObjList.append(sObj)
+                self.param.journal.add("resset", uid=uid, sid=sid, owner=str(sender))
+        except:
+            for sObj in sObjList:
+                self._resSetRemoveObject(uid, sObj.sid, sObj)
+            if uid in self.resSetDict and len(self.resSetDict[uid]) == 0:
+                del self.resSetDict[uid]
+            raise
+
+        # remove timeout
+        if self.param.timeoutHandler is not None:
+            GLib.source_remove(self.param.timeoutHandler)
+            self.param.timeoutHandler = None
+
+        # create tap interfaces in worker thread, all or nothing
+        def _work():
+            try:
+                ret = []
+                for sObj in sObjList:
+                    sObj._addTapIntf(network_name, VirtTapOptions())
+                    tapname = self.param.netManager.getTapIntf(uid, network_name, sObj.sid)
+                    macaddr = self.param.netManager.getVmMac(uid, network_name, sObj.sid)
+                    ipaddr = self.param.netManager.getVmIp(uid, network_name, sObj.sid)
+                    ret.append((sObj.sid, tapname, macaddr, ipaddr))
+                return ret
+            except:
+                for sObj in sObjList:
+                    sObj._removeTapIntf()
+                raise
+
+        def _error(e):
+            for sObj in sObjList:
+                # the owner may have gone during the work, _resSetRemove() removes the object then
+                if not sObj.releasing:
+                    self._resSetRemoveObject(uid, sObj.sid, sObj)
+            error_handler(e)
+
+        _runInWorker(self.param, [x.lock for x in sObjList], _work, reply_handler, _error)
+
+    @dbus.service.method('org.fpemud.VirtService', sender_keyword='sender', in_signature='i',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def DeleteVmResSet(self, sid, sender=None, reply_handler=None, error_handler=None):
         self._checkInitError()
         uid = VirtUtil.dbusGetUserId(self.connection, sender)
 
         resset = self._resSetGet(uid, sid)
-        if resset is None:
+        if resset is None or resset.releasing:
             raise VirtServiceException("virt-machine resource set not found")
 
         vm = self._resSetGetAttachedVm(uid, sid)
         if vm is not None:
             raise VirtServiceException("virt-machine resource set has been binded to virt-machine %s" % (vm.name))
 
-        self._resSetRemove(uid, sid, resset)
-
-        # add timeout
-        assert self.param.timeoutHandler is None
-        if len(self.resSetDict) == 0:
-            self.param.timeoutHandler = GLib.timeout_add_seconds(self.param.timeout, lambda *args: self.param.mainloop.quit())
+        self._resSetRemove(uid, sid, resset, reply_handler, error_handler)
 
     @dbus.service.method('org.fpemud.VirtService', sender_keyword='sender', in_signature='si', out_signature='i')
     def AttachVm(self, vmname, sid, sender=None):
@@ -220,11 +319,58 @@ class DbusMainObject(dbus.service.Object):
                     return vmObj
         return None
 
-    def _resSetRemove(self, uid, sid, resset):
+    def _resSetRemove(self, uid, sid, resset, reply_handler, error_handler):
+        # resources are released in worker thread, the object is kept until then so that its sid is not re-used
+        resset.releasing = True
+
+        def _done(ret):
+            self._resSetRemoveObject(uid, sid, resset)
+            reply_handler()
+
+        def _error(e):
+            self._resSetRemoveObject(uid, sid, resset)
+            error_handler(e)
+
+        _runInWorker(self.param, [resset.lock], resset._removeTapIntf, _done, _error)
+
+    def _resSetRemoveObject(self, uid, sid, resset):
         resset.release()
         del self.resSetDict[uid][sid]
         if len(self.resSetDict[uid]) == 0:
             del self.resSetDict[uid]
+        self.param.journal.remove("resset", uid=uid, sid=sid)
+
+        # add timeout
+        if len(self.resSetDict) == 0 and self.param.timeoutHandler is None:
+            self.param.timeoutHandler = GLib.timeout_add_seconds(self.param.timeout, lambda *args: self.param.mainloop.quit())
+
+    def _restoreResSets(self):
+        # networks and shares are restored before, we only need to re-create the dbus objects
+        tapRecordList = self.param.journal.getList("tap")
+        for record in self.param.journal.getList("resset"):
+            uid, sid = record["uid"], record["sid"]
+            sObj = DbusResSetObject(self.param, uid, sid, record["owner"])
+            for tr in tapRecordList:
+                if tr["uid"] == uid and tr["sid"] == sid:
+                    sObj.networkName = tr["network"]
+            if uid not in self.resSetDict:
+                self.resSetDict[uid] = dict()
+            self.resSetDict[uid][sid] = sObj
+
+        # tap interface whose resource set was not recorded, the previous instance crashed in the middle of NewVmResSet()
+        for tr in tapRecordList:
+            if tr["uid"] not in self.resSetDict or tr["sid"] not in self.resSetDict[tr["uid"]]:
+                if self.param.isInitialized("sambaServer"):
+                    vmip = self.param.netManager.getVmIp(tr["uid"], tr["network"], tr["sid"])
+                    self.param.sambaServer.networkRemoveShareAll(vmip)
+                self.param.netManager.removeTapIntf(tr["uid"], tr["network"], tr["sid"])
+                self.param.netManager.removeNetwork(tr["uid"], tr["network"])
+
+        # the owner may have exited when the daemon was not running
+        for ressetu in list(self.resSetDict.values()):
+            for resset in list(ressetu.values()):
+                if not dbus.SystemBus().name_has_owner(resset.owner):
+                    self._resSetRemove(resset.uid, resset.sid, resset, lambda: None, lambda e: None)
 
     def _vmRemove(self, uid, vmid, vm):
         vm.release()
@@ -242,17 +388,15 @@ class DbusResSetObject(dbus.service.Object):
         self.owner = owner
 
         self.networkName = None           # not None means tap interface is allocated
+        self.lock = threading.Lock()      # serializes the operations running in worker threads
+        self.releasing = False
 
         bus_name = dbus.service.BusName('org.fpemud.VirtService', bus=dbus.SystemBus())
         dbus.service.Object.__init__(self, bus_name, '/org/fpemud/VirtService/%d/VmResSets/%d' % (self.uid, self.sid))
 
     def release(self):
-        if self.networkName is not None:
-            vmip = self.param.netManager.getVmIp(self.uid, self.networkName, self.sid)
-            self.param.sambaServer.networkRemoveShareAll(vmip)
-            self.param.netManager.removeTapIntf(self.uid, self.networkName, self.sid)
-            self.param.netManager.removeNetwork(self.uid, self.networkName)
-            self.networkName = None
+        # resources should be released by self._removeTapIntf() before
+        assert self.networkName is None
         self.remove_from_connection()
 
     @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender', out_signature='s')
@@ -262,6 +406,32 @@ class DbusResSetObject(dbus.service.Object):
             raise VirtServiceException("no tap interface found in the specified virt-machine resource set")
         return self.param.netManager.getTapIntf(self.uid, self.networkName, self.sid)
 
+    @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender', out_signature='a{sv}')
+    def GetTapIntfOptions(self, sender):
+        assert self.uid == VirtUtil.dbusGetUserId(self.connection, sender)
+        if self.networkName is None:
+            raise VirtServiceException("no tap interface found in the specified virt-machine resource set")
+        options = self.param.netManager.getTapIntfOptions(self.uid, self.networkName, self.sid)
+        return {
+            "queues": dbus.Int32(options.queues),
+            "vnet_hdr": dbus.Boolean(options.vnetHdr),
+            "offloads": dbus.Array(options.offloads, signature='s'),
+        }
+
+    @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender', out_signature='ah')
+    def GetTapIntfFds(self, sender):
+        assert self.uid == VirtUtil.dbusGetUserId(self.connection, sender)
+        if self.networkName is None:
+            raise VirtServiceException("no tap interface found in the specified virt-machine resource set")
+
+        # dbus.types.UnixFd duplicates the file descriptor, so we close ours
+        fdList = self.param.netManager.openTapIntfQueues(self.uid, self.networkName, self.sid)
+        try:
+            return [dbus.types.UnixFd(fd) for fd in fdList]
+        finally:
+            for fd in fdList:
+                os.close(fd)
+
     @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender', out_signature='s')
     def GetVmMacAddr(self, sender):
         assert self.uid == VirtUtil.dbusGetUserId(self.connection, sender)
@@ -276,59 +446,271 @@ class DbusResSetObject(dbus.service.Object):
             raise VirtServiceException("no tap interface found in the specified virt-machine resource set")
         return self.param.netManager.getVmIp(self.uid, self.networkName, self.sid)
 
-    @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender', in_signature='s')
-    def AddTapIntf(self, network_name, sender):
+    @dbus.service.signal('org.fpemud.VirtService.VmResSet', signature='ss')
+    def VmNetworkReady(self, ipaddr, macaddr):
+        pass
+
+    @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender', in_signature='s',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def AddTapIntf(self, network_name, sender, reply_handler, error_handler):
         assert self.uid == VirtUtil.dbusGetUserId(self.connection, sender)
-        if self.networkName is not None:
-            raise VirtServiceException("tap interface exists in the specified virt-machine resource set")
+        _runInWorker(self.param, [self.lock], lambda: self._addTapIntf(network_name, VirtTapOptions()),
+                     lambda ret: reply_handler(), error_handler)
 
-        self.param.netManager.addNetwork(self.uid, network_name)
-        self.networkName = network_name
+    @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender', in_signature='sa{sv}',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def AddTapIntfWithOptions(self, network_name, options, sender, reply_handler, error_handler):
+        assert self.uid == VirtUtil.dbusGetUserId(self.connection, sender)
+        options = _parseTapOptions(options)
+        _runInWorker(self.param, [self.lock], lambda: self._addTapIntf(network_name, options),
+                     lambda ret: reply_handler(), error_handler)
 
-        try:
-            self.param.netManager.addTapIntf(self.uid, network_name, self.sid)
-        except:
-            self.param.netManager.removeNetwork(self.uid, self.networkName)
-            self.networkName = None
+    @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def RemoveTapIntf(self, sender, reply_handler, error_handler):
+        assert self.uid == VirtUtil.dbusGetUserId(self.connection, sender)
+        _runInWorker(self.param, [self.lock], self._removeTapIntf,
+                     lambda ret: reply_handler(), error_handler)
 
-    @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender')
-    def RemoveTapIntf(self, sender):
+    @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender', in_signature='ssb',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def NewSambaShare(self, share_name, share_path, readonly, sender, reply_handler, error_handler):
         assert self.uid == VirtUtil.dbusGetUserId(self.connection, sender)
 
-        if self.networkName is None:
-            return
+        _checkShareName(share_name)
+        if not os.path.isabs(share_path):
+            raise VirtServiceException("share_path must be absoulte path")
 
-        self.param.netManager.removeTapIntf(self.uid, self.networkName, self.sid)
-        self.param.netManager.removeNetwork(self.uid, self.networkName)
-        self.networkName = None
+        def _work():
+            self._startSambaServer()
+            vmip = self.param.netManager.getVmIp(self.uid, self.networkName, self.sid)
+
+            def _done(ret):
+                if ret == 0:
+                    reply_handler()
+                elif ret == 1:
+                    error_handler(VirtServiceException("the specified samba share duplicates"))
+                elif ret == 2:
+                    error_handler(VirtServiceException("no samba service on the network of %s" % (vmip)))
+                else:
+                    assert False
+
+            self.param.sambaServer.networkAddShare(vmip, self.uid, share_name, share_path, readonly, _done, error_handler)
+
+        # the reply is sent after the samba configuration is applied
+        _runInWorker(self.param, [self.lock], _work, lambda ret: None, error_handler)
+
+    @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender', in_signature='s',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def DeleteSambaShare(self, share_name, sender, reply_handler, error_handler):
+        assert self.uid == VirtUtil.dbusGetUserId(self.connection, sender)
+
+        def _work():
+            if self.networkName is None:
+                return False
+            if not self.param.isInitialized("sambaServer"):
+                return False                            # no share has been created
+
+            vmip = self.param.netManager.getVmIp(self.uid, self.networkName, self.sid)
+            self.param.sambaServer.networkRemoveShare(vmip, share_name, lambda ret: reply_handler(), error_handler)
+            return True
+
+        def _done(waiting):
+            # the reply is sent after the samba configuration is applied
+            if not waiting:
+                reply_handler()
+
+        _runInWorker(self.param, [self.lock], _work, _done, error_handler)
+
+    @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender', in_signature='a(ssb)', out_signature='ai',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def NewSambaShares(self, shares, sender, reply_handler, error_handler):
+        assert self.uid == VirtUtil.dbusGetUserId(self.connection, sender)
+
+        shareList = []
+        for share_name, share_path, readonly in shares:
+            _checkShareName(share_name)
+            if not os.path.isabs(share_path):
+                raise VirtServiceException("share_path must be absoulte path")
+            shareList.append((str(share_name), str(share_path), bool(readonly)))
+
+        def _work():
+            self._startSambaServer()
+            vmip = self.param.netManager.getVmIp(self.uid, self.networkName, self.sid)
 
-    @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender', in_signature='ssb')
-    def NewSambaShare(self, share_name, share_path, readonly, sender):
+            def _done(ret):
+                if 2 in ret:
+                    error_handler(VirtServiceException("no samba service on the network of %s" % (vmip)))
+                else:
+                    reply_handler(dbus.Array(ret, signature='i'))
+
+            self.param.sambaServer.networkAddShares(vmip, self.uid, shareList, _done, error_handler)
+
+        # the reply is sent after the samba configuration is applied
+        _runInWorker(self.param, [self.lock], _work, lambda ret: None, error_handler)
+
+    @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender', in_signature='as', out_signature='ai',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def DeleteSambaShares(self, share_names, sender, reply_handler, error_handler):
+        assert self.uid == VirtUtil.dbusGetUserId(self.connection, sender)
+
+        shareNameList = [str(x) for x in share_names]
+
+        def _work():
+            if self.networkName is None or not self.param.isInitialized("sambaServer"):
+                return [1] * len(shareNameList)        # no share has been created
+
+            vmip = self.param.netManager.getVmIp(self.uid, self.networkName, self.sid)
+            self.param.sambaServer.networkRemoveShares(vmip, shareNameList, lambda ret: reply_handler(dbus.Array(ret, signature='i')), error_handler)
+            return None
+
+        def _done(ret):
+            # the reply is sent after the samba configuration is applied
+            if ret is not None:
+                reply_handler(dbus.Array(ret, signature='i'))
+
+        _runInWorker(self.param, [self.lock], _work, _done, error_handler)
+
+    @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender', in_signature='ssa{sv}', out_signature='s',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def NewVirtiofsShare(self, share_name, share_path, options, sender, reply_handler, error_handler):
         assert self.uid == VirtUtil.dbusGetUserId(self.connection, sender)
 
+        _checkShareName(share_name)
         if not os.path.isabs(share_path):
             raise VirtServiceException("share_path must be absoulte path")
-        if self.networkName is None:
-            raise VirtServiceException("no network resource found in the specified virt-machine resource set")
+        cacheMode, threadPoolSize = _parseVirtiofsOptions(options)
 
-        vmip = self.param.netManager.getVmIp(self.uid, self.networkName, self.sid)
-        ret = self.param.sambaServer.networkAddShare(vmip, self.uid, share_name, share_path, readonly)
-        if ret == 0:
-            pass
-        elif ret == 1:
-            raise VirtServiceException("the specified samba share duplicates")
-        else:
-            assert False
+        def _work():
+            if self.networkName is None:
+                raise VirtServiceException("no network resource found in the specified virt-machine resource set")
+
+            netTmpDir = self.param.netManager.getNetworkTmpDir(self.uid, self.networkName)
+            ret = self.param.virtiofsServer.addShare(self.uid, self.sid, netTmpDir, str(share_name), str(share_path), cacheMode, threadPoolSize)
+            if ret is None:
+                raise VirtServiceException("the specified virtiofs share duplicates")
+            return ret
 
-    @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender', in_signature='s')
-    def DeleteSambaShare(self, share_name, sender):
+        _runInWorker(self.param, [self.lock], _work, reply_handler, error_handler)
+
+    @dbus.service.method('org.fpemud.VirtService.VmResSet', sender_keyword='sender', in_signature='s',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def DeleteVirtiofsShare(self, share_name, sender, reply_handler, error_handler):
         assert self.uid == VirtUtil.dbusGetUserId(self.connection, sender)
 
+        def _work():
+            if not self.param.isInitialized("virtiofsServer"):
+                return                                  # no share has been created
+            self.param.virtiofsServer.removeShare(self.uid, self.sid, str(share_name))
+
+        _runInWorker(self.param, [self.lock], _work, lambda ret: reply_handler(), error_handler)
+
+    def _addTapIntf(self, network_name, options):
+        # runs in worker thread with self.lock held
+        if self.releasing:
+            raise VirtServiceException("virt-machine resource set is being deleted")
+        if self.networkName is not None:
+            raise VirtServiceException("tap interface exists in the specified virt-machine resource set")
+
+        # self.networkName is set at last, so that the getters running in main thread don't see a half-created tap interface
+        with self.param.netManager.getNetworkLock(self.uid, network_name):
+            self.param.netManager.addNetwork(self.uid, network_name)
+            try:
+                self.param.netManager.addTapIntf(self.uid, network_name, self.sid, options)
+            except:
+                self.param.netManager.removeNetwork(self.uid, network_name)
+                raise
+        self.networkName = network_name
+
+    def _startSambaServer(self):
+        # runs in worker thread with self.lock held
         if self.networkName is None:
+            raise VirtServiceException("no network resource found in the specified virt-machine resource set")
+        with self.param.netManager.getNetworkLock(self.uid, self.networkName):
+            if not self.param.netManager.startSambaServer(self.uid, self.networkName):
+                raise VirtServiceException("samba share is not supported in network \"%s\"" % (self.networkName))
+
+    def _removeTapIntf(self):
+        # runs in worker thread with self.lock held
+        if self.networkName is None:
+            return
+
+        networkName = self.networkName
+        self.networkName = None
+        with self.param.netManager.getNetworkLock(self.uid, networkName):
+            if self.param.isInitialized("sambaServer"):
+                vmip = self.param.netManager.getVmIp(self.uid, networkName, self.sid)
+                self.param.sambaServer.networkRemoveShareAll(vmip)
+            if self.param.isInitialized("virtiofsServer"):
+                self.param.virtiofsServer.removeShareAll(self.uid, self.sid)      # sockets are in the network temp directory
+            self.param.netManager.removeTapIntf(self.uid, networkName, self.sid)
+            self.param.netManager.removeNetwork(self.uid, networkName)
+
+
+def _runInWorker(param, lockList, func, doneFunc, errorFunc):
+    """Runs func() in the worker pool with all the locks in lockList held,
+       then doneFunc(ret) or errorFunc(exception) is called in the main loop"""
+
+    def _callInMainLoop(f, arg):
+        f(arg)
+        return False
+
+    def _work():
+        try:
+            with contextlib.ExitStack() as stack:
+                for lock in lockList:
+                    stack.enter_context(lock)
+                ret = func()
+        except Exception as e:
+            GLib.idle_add(_callInMainLoop, errorFunc, e)
             return
+        GLib.idle_add(_callInMainLoop, doneFunc, ret)
+
+    param.workerPool.submit(_work)
+
+
+def _checkShareName(share_name):
+    if share_name == "" or "_" in share_name or "/" in share_name or "]" in share_name:
+        raise VirtServiceException("invalid share name \"%s\"" % (share_name))
+
+
+def _parseVirtiofsOptions(options):
+    for key in options:
+        if key not in ["cache", "thread_pool_size"]:
+            raise VirtServiceException("invalid virtiofs share option \"%s\"" % (key))
+
+    cacheMode = str(options.get("cache", "auto"))
+    if cacheMode not in ["auto", "always", "never", "metadata"]:
+        raise VirtServiceException("invalid virtiofs cache mode \"%s\"" % (cacheMode))
+
+    threadPoolSize = None
+    if "thread_pool_size" in options:
+        threadPoolSize = int(options["thread_pool_size"])
+        if not (0 <= threadPoolSize <= 1024):
+            raise VirtServiceException("virtiofs share option \"thread_pool_size\" must be in range [0,1024]")
+
+    return (cacheMode, threadPoolSize)
+
+
+def _parseTapOptions(options):
+    for key in options:
+        if key not in ["queues", "vnet_hdr", "offloads"]:
+            raise VirtServiceException("invalid tap interface option \"%s\"" % (key))
+
+    queues = int(options.get("queues", 1))
+    if not (1 <= queues <= 256):
+        raise VirtServiceException("tap interface option \"queues\" must be in range [1,256]")
+
+    vnetHdr = bool(options.get("vnet_hdr", False))
+
+    offloads = [str(x) for x in options.get("offloads", [])]
+    for o in offloads:
+        if o not in ["csum", "tso4", "tso6", "tso_ecn", "ufo"]:
+            raise VirtServiceException("invalid offload flag \"%s\"" % (o))
+    if len(offloads) > 0 and not vnetHdr:
+        raise VirtServiceException("tap interface option \"offloads\" needs option \"vnet_hdr\"")
 
-        vmip = self.param.netManager.getVmIp(self.uid, self.networkName, self.sid)
-        self.param.sambaServer.networkRemoveShare(vmip, share_name)
+    return VirtTapOptions(queues, vnetHdr, offloads)
 
 
 class DbusVmObject(dbus.service.Object):
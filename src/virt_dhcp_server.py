@@ -2,19 +2,36 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
+import re
+import time
+import signal
+import threading
 import subprocess
+from gi.repository import Gio
 from virt_util import VirtUtil
 from virt_param import VirtInitializationError
 
 
 class VirtDhcpServer:
 
+    """DHCP and DNS server for nat and route networks, param.dhcpServerMode selects how dnsmasq is run:
+         shared:       one dnsmasq for all the networks, networks are added and removed by SIGHUP
+         per-network:  one dnsmasq for each network
+       Only the resource sets which have a tap interface get a DHCP reservation, reservations are kept in
+       dhcp-hostsfile, which dnsmasq re-reads on SIGHUP, so no restart is needed when they change.
+       A network is usable only after dnsmasq listens on its bridge address. The lease file is monitored,
+       param.dbusMainObject is notified when a guest gets or renews its lease."""
+
     def __init__(self, param):
         self.param = param
-        self.serverObjDict = dict()
+        self.serverObjDict = dict()      # { netObj: serverObj }
+        self.sharedServer = None
+        self.lock = threading.Lock()
 
         if not os.path.exists("/usr/sbin/dnsmasq"):
             raise VirtInitializationError("/usr/sbin/dnsmasq not found")
+
+        # dnsmasq left by the previous daemon instance has been stopped by removeStaleServers()
         if VirtUtil.isSocketPortUsed("tcp", 53):
             raise VirtInitializationError("TCP port 53 has been already used")
         if VirtUtil.isSocketPortUsed("udp", 53):
@@ -22,14 +39,74 @@ class VirtDhcpServer:
 
     def release(self):
         assert len(self.serverObjDict) == 0
+        assert self.sharedServer is None
+
+    @staticmethod
+    def removeStaleServers(param):
+        """Stops all the dnsmasq processes left behind by crashed daemon instances, called once at startup before
+           the networks are restored, a restored network gets a new dnsmasq from startOnNetwork(), which must not
+           find port 53 used by the old one. The subsystem needs not to be initialized."""
+
+        if not os.path.isdir(param.runDir):
+            return
+        for fn in os.listdir(param.runDir):
+            if re.fullmatch("dnsmasq\\..*\\.pid", fn) is not None:
+                VirtUtil.killProcessByPidFile(os.path.join(param.runDir, fn), "dnsmasq")
+
+    def _onLease(self, netObj, sid, ip, mac):
+        # called in main loop
+        if self.param.dbusMainObject is not None:
+            self.param.dbusMainObject.onVmNetworkReady(netObj.uid, sid, ip, mac)
 
     def startOnNetwork(self, netObj):
-        self.serverObjDict[netObj] = _ServerLocal(self, netObj)
+        if self.param.dhcpServerMode == "shared":
+            with self.lock:
+                if self.sharedServer is None:
+                    self.sharedServer = _ServerShared(self)
+                try:
+                    self.sharedServer.addNetwork(netObj)
+                except:
+                    self._releaseSharedServerIfEmpty()
+                    raise
+                self.serverObjDict[netObj] = self.sharedServer
+                serverProc = self.sharedServer.serverProc
+
+            # dnsmasq binds to the new bridge asynchronously, it takes a while, so self.lock is not held
+            try:
+                _waitServerReady(serverProc, [netObj.brip])
+            except:
+                self.stopOnNetwork(netObj)
+                raise
+        elif self.param.dhcpServerMode == "per-network":
+            serverObj = _ServerLocal(self, netObj)
+            with self.lock:
+                self.serverObjDict[netObj] = serverObj
+        else:
+            assert False
+
+    def addHost(self, netObj, sid):
+        with self.lock:
+            self.serverObjDict[netObj].addHost(netObj, sid)
+
+    def removeHost(self, netObj, sid):
+        with self.lock:
+            self.serverObjDict[netObj].removeHost(netObj, sid)
 
     def stopOnNetwork(self, netObj):
-        serverObj = self.serverObjDict.pop(netObj)
+        with self.lock:
+            serverObj = self.serverObjDict.pop(netObj)
+            if serverObj is self.sharedServer:
+                self.sharedServer.removeNetwork(netObj)
+                self._releaseSharedServerIfEmpty()
+                return
         serverObj.release()
 
+    def _releaseSharedServerIfEmpty(self):
+        # called with self.lock held, a dead dnsmasq is not kept for the next network
+        if self.sharedServer.isEmpty():
+            self.sharedServer.release()
+            self.sharedServer = None
+
 
 class _ServerLocal:
 
@@ -38,18 +115,53 @@ class _ServerLocal:
         assert netObj.netmask == "255.255.255.0"
         assert netObj.brip.endswith(".1")
 
+        self.pObj = pObj
         self.param = pObj.param
         self.netObj = netObj
         self.confFile = os.path.join(self.netObj.getTmpDir(), "dnsmasq.conf")
+        self.hostsFile = os.path.join(self.netObj.getTmpDir(), "dnsmasq.hosts")
+        self.leaseFile = os.path.join(self.netObj.getTmpDir(), "dnsmasq.leases")
+        self.pidFile = os.path.join(self.param.runDir, "dnsmasq.%s.pid" % (self.netObj.brname))
+        self.sidSet = set()
         self.serverProc = None
+        self.leaseMonitor = None
 
+        VirtUtil.killProcessByPidFile(self.pidFile, "dnsmasq")      # dnsmasq started by the previous daemon instance may still be running
         self._genDnsmasqCfgFile()
-        self.serverProc = subprocess.Popen(self._genDnsmasqCommand(), shell=True)
+        _writeHostsFile(self.hostsFile, self.netObj, self.sidSet)
+        self.leaseMonitor = _LeaseMonitor(self.leaseFile, self._onLease)
+        try:
+            self.serverProc = _startServer(self.confFile, self.pidFile, self.leaseFile)
+            _waitServerReady(self.serverProc, [self.netObj.brip])
+        except:
+            self.release()
+            raise
 
     def release(self):
+        self.leaseMonitor.release()
+        self.leaseMonitor = None
+        if self.serverProc is None:
+            return
         self.serverProc.terminate()
         self.serverProc.wait()
         self.serverProc = None
+        VirtUtil.forceDelete(self.pidFile)
+
+    def addHost(self, netObj, sid):
+        assert sid not in self.sidSet
+        self.sidSet.add(sid)
+        _writeHostsFile(self.hostsFile, self.netObj, self.sidSet)
+        self.serverProc.send_signal(signal.SIGHUP)
+
+    def removeHost(self, netObj, sid):
+        self.sidSet.remove(sid)
+        _writeHostsFile(self.hostsFile, self.netObj, self.sidSet)
+        self.serverProc.send_signal(signal.SIGHUP)
+
+    def _onLease(self, ip, mac):
+        sid = _getLeaseSid(self.netObj, self.sidSet, ip, mac)
+        if sid is not None:
+            self.pObj._onLease(self.netObj, sid, ip, mac)
 
     def _genDnsmasqCfgFile(self):
         buf = ""
@@ -59,16 +171,223 @@ class _ServerLocal:
         buf += "interface=%s\n" % (self.netObj.brname)
         buf += "listen-address=%s\n" % (self.netObj.brip)
         buf += "dhcp-range=%s,static,%s\n" % (self.netObj.netip, self.netObj.netmask)
-        for sid in range(1, 128 + 1):
-            buf += "dhcp-host=%s,%s\n" % (self.netObj.getVmMac(sid), self.netObj.getVmIp(sid))
+        buf += "dhcp-hostsfile=%s\n" % (self.hostsFile)
         VirtUtil.writeFile(self.confFile, buf)
 
-    def _genDnsmasqCommand(self):
-        # no pid-file, no lease-file
-        # dnsmasq polls /etc/resolv.conf to get the dns change, it's good :)
-        cmd = "/usr/sbin/dnsmasq"
-        cmd += " --keep-in-foreground"                        # don't run as daemon, so we can control it
-        cmd += " --conf-file=\"%s\"" % (self.confFile)
-        cmd += " --pid-file"
-        cmd += " --dhcp-no-override"
-        return cmd
+
+class _ServerShared:
+
+    """One dnsmasq bound to all the vnb* interfaces.
+       Every network is a /24 in 10.0.0.0/8, so one static dhcp-range covers all of them, the real netmask and
+       broadcast address are sent by the options tagged with the bridge name, dnsmasq tags each request with
+       the name of the interface it arrives on. Router and DNS server default to the bridge address.
+       Each network has a file in the hosts directory and one in the options directory, dnsmasq re-reads them on SIGHUP.
+       Only known hosts are served, so bridges of bridge networks, whose VMs have no reservation, are never answered."""
+
+    def __init__(self, pObj):
+        self.pObj = pObj
+        self.param = pObj.param
+        self.dir = os.path.join(self.param.tmpDir, "dnsmasq")
+        self.confFile = os.path.join(self.dir, "dnsmasq.conf")
+        self.hostsDir = os.path.join(self.dir, "hosts")
+        self.optsDir = os.path.join(self.dir, "opts")
+        self.leaseFile = os.path.join(self.dir, "dnsmasq.leases")
+        self.pidFile = os.path.join(self.param.runDir, "dnsmasq.shared.pid")
+        self.sidSetDict = dict()              # { netObj: set(sid) }
+        self.serverProc = None
+
+        VirtUtil.mkDirAndClear(self.dir)
+        os.mkdir(self.hostsDir)
+        os.mkdir(self.optsDir)
+        self._genDnsmasqCfgFile()
+        self.leaseMonitor = _LeaseMonitor(self.leaseFile, self._onLease)
+
+    def release(self):
+        assert len(self.sidSetDict) == 0
+        self.leaseMonitor.release()
+        self.leaseMonitor = None
+        if self.serverProc is not None:
+            self.serverProc.terminate()
+            self.serverProc.wait()
+            self.serverProc = None
+        VirtUtil.forceDelete(self.pidFile)
+        VirtUtil.forceDelete(self.dir)
+
+    def isEmpty(self):
+        return len(self.sidSetDict) == 0
+
+    def addNetwork(self, netObj):
+        assert netObj.netip.endswith(".0")
+        assert netObj.netmask == "255.255.255.0"
+        assert netObj.brip.endswith(".1")
+
+        self.sidSetDict[netObj] = set()
+        _writeHostsFile(os.path.join(self.hostsDir, netObj.brname), netObj, self.sidSetDict[netObj])
+
+        buf = ""
+        buf += "tag:%s,option:netmask,%s\n" % (netObj.brname, netObj.netmask)
+        buf += "tag:%s,option:broadcast,%s\n" % (netObj.brname, netObj.netip[:-len(".0")] + ".255")
+        VirtUtil.writeFileAtomic(os.path.join(self.optsDir, netObj.brname), buf)
+
+        try:
+            self._reload()
+        except:
+            del self.sidSetDict[netObj]
+            os.remove(os.path.join(self.hostsDir, netObj.brname))
+            os.remove(os.path.join(self.optsDir, netObj.brname))
+            raise
+
+    def removeNetwork(self, netObj):
+        assert len(self.sidSetDict[netObj]) == 0
+        del self.sidSetDict[netObj]
+        os.remove(os.path.join(self.hostsDir, netObj.brname))
+        os.remove(os.path.join(self.optsDir, netObj.brname))
+        if len(self.sidSetDict) > 0:
+            self._reload()
+
+    def addHost(self, netObj, sid):
+        assert sid not in self.sidSetDict[netObj]
+        self.sidSetDict[netObj].add(sid)
+        _writeHostsFile(os.path.join(self.hostsDir, netObj.brname), netObj, self.sidSetDict[netObj])
+        self._reload()
+
+    def removeHost(self, netObj, sid):
+        self.sidSetDict[netObj].remove(sid)
+        _writeHostsFile(os.path.join(self.hostsDir, netObj.brname), netObj, self.sidSetDict[netObj])
+        self._reload()
+
+    def _onLease(self, ip, mac):
+        # sidSetDict is changed by worker threads, it is copied in one step instead of waiting for the lock in main loop
+        for netObj, sidSet in list(self.sidSetDict.items()):
+            sid = _getLeaseSid(netObj, sidSet, ip, mac)
+            if sid is not None:
+                self.pObj._onLease(netObj, sid, ip, mac)
+                break
+
+    def _reload(self):
+        if self.serverProc is None or self.serverProc.poll() is not None:
+            # dnsmasq started by the previous daemon instance may still be running
+            # dnsmasq that has died is replaced, it would fail every network otherwise
+            VirtUtil.killProcessByPidFile(self.pidFile, "dnsmasq")
+            self.serverProc = _startServer(self.confFile, self.pidFile, self.leaseFile)
+        else:
+            self.serverProc.send_signal(signal.SIGHUP)
+
+    def _genDnsmasqCfgFile(self):
+        buf = ""
+        buf += "strict-order\n"
+        buf += "bind-dynamic\n"                              # listen on the bridges created later
+        buf += "except-interface=lo\n"                       # don't listen on 127.0.0.1
+        buf += "interface=vnb*\n"
+        buf += "dhcp-range=10.0.0.0,static,255.0.0.0\n"
+        buf += "dhcp-hostsfile=%s\n" % (self.hostsDir)
+        buf += "dhcp-optsfile=%s\n" % (self.optsDir)
+        VirtUtil.writeFile(self.confFile, buf)
+
+
+def _writeHostsFile(filename, netObj, sidSet):
+    # dhcp-hostsfile format, the same as dhcp-host option without "dhcp-host="
+    buf = ""
+    for sid in sorted(sidSet):
+        buf += "%s,%s\n" % (netObj.getVmMac(sid), netObj.getVmIp(sid))
+    VirtUtil.writeFileAtomic(filename, buf)
+
+
+def _startServer(confFile, pidFile, leaseFile):
+    # pid-file is used to find the stale process after daemon restart
+    # lease-file is in temp directory, it is monitored to know when the guest gets its address
+    # dnsmasq polls /etc/resolv.conf to get the dns change, it's good :)
+    cmd = ["/usr/sbin/dnsmasq"]
+    cmd.append("--keep-in-foreground")                      # don't run as daemon, so we can control it
+    cmd.append("--conf-file=%s" % (confFile))
+    cmd.append("--pid-file=%s" % (pidFile))
+    cmd.append("--dhcp-leasefile=%s" % (leaseFile))
+    cmd.append("--dhcp-no-override")
+    proc = subprocess.Popen(cmd)
+
+    # dnsmasq writes pid-file after its signal handlers are installed, SIGHUP would kill it before that
+    for i in range(0, 100):
+        if os.path.exists(pidFile) or proc.poll() is not None:
+            break
+        time.sleep(0.01)
+    return proc
+
+
+def _waitServerReady(proc, addrList):
+    # dnsmasq is ready when it listens on the DHCP port and on the DNS port of every specified address
+    # only the sockets opened by this dnsmasq are counted, other DHCP or DNS servers may be running
+    for i in range(0, 200):
+        if proc.poll() is not None:
+            raise Exception("dnsmasq exited with code %d" % (proc.returncode))
+        inodeSet = _getSocketInodeSet(proc.pid)
+        if any(x[3] in inodeSet for x in VirtUtil.getListeningSockets("udp", 67)):
+            dnsAddrSet = set(x[0] for x in VirtUtil.getListeningSockets("tcp", 53) if x[3] in inodeSet)
+            if all(x in dnsAddrSet for x in addrList):
+                return
+        time.sleep(0.01)
+    raise Exception("dnsmasq is not listening on %s" % (", ".join(addrList)))
+
+
+def _getSocketInodeSet(pid):
+    ret = set()
+    fdDir = "/proc/%d/fd" % (pid)
+    try:
+        fdList = os.listdir(fdDir)
+    except OSError:
+        return ret                                          # process has exited
+    for fd in fdList:
+        try:
+            m = re.fullmatch("socket:\\[([0-9]+)\\]", os.readlink(os.path.join(fdDir, fd)))
+        except OSError:
+            continue                                        # fd has been closed
+        if m is not None:
+            ret.add(int(m.group(1)))
+    return ret
+
+
+def _getLeaseSid(netObj, sidSet, ip, mac):
+    # returns the sid of the reservation that the lease is for, returns None if the lease belongs to others
+    for sid in list(sidSet):
+        if netObj.getVmIp(sid) == ip and netObj.getVmMac(sid) == mac:
+            return sid
+    return None
+
+
+class _LeaseMonitor:
+
+    """Watches the lease file of dnsmasq, which is rewritten when a lease is added, renewed or deleted.
+       The callback is called in main loop for each lease that is new or whose expiry time has changed."""
+
+    def __init__(self, leaseFile, func):
+        self.leaseFile = leaseFile
+        self.func = func
+        self.leaseDict = dict()              # { (ip, mac): expiry }
+
+        self.monitor = Gio.File.new_for_path(self.leaseFile).monitor_file(Gio.FileMonitorFlags.NONE, None)
+        self.monitor.set_rate_limit(100)
+        self.monitor.connect("changed", self._onChanged)
+
+    def release(self):
+        self.monitor.cancel()
+        self.monitor = None
+
+    def _onChanged(self, monitor, file, otherFile, eventType):
+        if eventType not in [Gio.FileMonitorEvent.CREATED, Gio.FileMonitorEvent.CHANGED, Gio.FileMonitorEvent.CHANGES_DONE_HINT]:
+            return
+
+        # lease file format: "expiry mac ip hostname client-id", one lease per line
+        # dnsmasq rewrites the file in place, the last line is ignored if it is not completely written yet
+        newLeaseDict = dict()
+        try:
+            buf = VirtUtil.readFile(self.leaseFile)
+        except OSError:
+            return
+        for line in buf.split("\n")[:-1]:
+            items = line.split(" ")
+            if len(items) >= 3:
+                newLeaseDict[(items[2], items[1])] = items[0]
+
+        for key, expiry in newLeaseDict.items():
+            if self.leaseDict.get(key, None) != expiry:
+                self.func(*key)
+        self.leaseDict = newLeaseDict
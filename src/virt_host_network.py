@@ -2,70 +2,258 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import dbus
+import errno
+import socket
+import threading
+from pyroute2.netlink.rtnl import RTMGRP_LINK
+from pyroute2.netlink.rtnl import RTMGRP_IPV4_ROUTE
+from pyroute2.netlink.rtnl.marshal import MarshalRtnl
+from gi.repository import GLib
+from virt_param import VirtInitializationError
 
 
 class VirtHostNetwork:
 
-    """The network management program on host machine"""
+    """The network management program on host machine.
+       Active interfaces are the uplinks of the host, they are tracked by one of the following backends:
+         rtnetlink:       interfaces which are up and have an IPv4 default route, derived from link and route notifications
+         networkmanager:  devices of the active connections of NetworkManager
+       param.hostNetworkBackend selects the backend, "auto" uses rtnetlink and falls back to NetworkManager.
+       Changes are coalesced in a window of param.hostNetworkDebounceTime milliseconds, only the net difference
+       is delivered to callback objects, in one batch for each of them."""
 
-    def __init__(self):
+    def __init__(self, param):
+        self.param = param
         self.cbObjList = []              # callback objects
-        self.intfSet = set()             # active interface name list
-
-        # NetworkManager: register signal, fill self.intfSet
-        if dbus.SystemBus().name_has_owner("org.freedesktop.NetworkManager"):
-            nmObj = dbus.SystemBus().get_object('org.freedesktop.NetworkManager', '/org/freedesktop/NetworkManager')
-            nmObj.connect_to_signal("PropertiesChanged", self._eventProcNetworkManagerPropertiesChanged, dbus_interface="org.freedesktop.NetworkManager")
-            for oconn in nmObj.Get("org.freedesktop.NetworkManager", "ActiveConnections", dbus_interface="org.freedesktop.DBus.Properties"):
-                connObj = dbus.SystemBus().get_object('org.freedesktop.NetworkManager', oconn)
-                for odev in connObj.Get("org.freedesktop.NetworkManager.Connection.Active", "Devices", dbus_interface="org.freedesktop.DBus.Properties"):
-                    devObj = dbus.SystemBus().get_object('org.freedesktop.NetworkManager', odev)
-                    intf = devObj.Get("org.freedesktop.NetworkManager.Device", "IpInterface", dbus_interface="org.freedesktop.DBus.Properties")
-                    self.intfSet.add(intf)
+        self.intfSet = set()             # active interface name list, as delivered to callback objects
+        self.lock = threading.RLock()    # callback objects are registered in worker threads
+        self.backend = None
+
+        # debounce
+        self.pendingIntfSet = set()      # latest active interface name list reported by backend
+        self.pendingChangeCount = 0      # interface changes reported by backend since last delivery
+        self.flushHandler = None
+
+        # statistics
+        self.eventCount = 0              # updates reported by backend
+        self.deliveredCount = 0          # interface changes delivered to callback objects
+        self.suppressedCount = 0         # interface changes cancelled out in debounce window
+
+        backendName = self.param.hostNetworkBackend
+        if backendName in ["auto", "rtnetlink"]:
+            try:
+                self.backend = _BackendRtnetlink(self)
+            except OSError:
+                if backendName == "rtnetlink":
+                    raise
+        if self.backend is None and backendName in ["auto", "networkmanager"]:
+            if dbus.SystemBus().name_has_owner("org.freedesktop.NetworkManager"):
+                self.backend = _BackendNetworkManager(self)
+        if self.backend is None:
+            raise VirtInitializationError("no usable host network backend")
+
+    def release(self):
+        if self.flushHandler is not None:
+            GLib.source_remove(self.flushHandler)
+            self.flushHandler = None
+        self.backend.release()
+        self.backend = None
 
     def registerEventCallback(self, cbObject):
         assert isinstance(cbObject, VirtHostNetworkEventCallback)
-        self.cbObjList.append(cbObject)
-
-        for ai in self.intfSet:
-            cbObject.onActiveInterfaceAdd(ai)
+        with self.lock:
+            self.cbObjList.append(cbObject)
+            if len(self.intfSet) > 0:
+                cbObject.onActiveInterfaceChange(sorted(self.intfSet), [])
 
     def unregisterEventCallback(self, cbObject):
         assert isinstance(cbObject, VirtHostNetworkEventCallback)
-        self.cbObjList.remove(cbObject)
+        with self.lock:
+            self.cbObjList.remove(cbObject)
 
-    def _eventProcNetworkManagerPropertiesChanged(self, props):
-        if 'ActiveConnections' not in props:
-            return
+    def _updateIntfSet(self, newIntfSet):
+        # called by backend with the complete set of active interfaces
+        with self.lock:
+            self.eventCount += 1
+            self.pendingChangeCount += len(self.pendingIntfSet.symmetric_difference(newIntfSet))
+            self.pendingIntfSet = set(newIntfSet)
 
-        # get the new interface list
-        newIntfSet = set()
-        for oconn in props['ActiveConnections']:
-            connObj = dbus.SystemBus().get_object('org.freedesktop.NetworkManager', oconn)
-            for odev in connObj.Get("org.freedesktop.NetworkManager.Connection.Active", "Devices", dbus_interface="org.freedesktop.DBus.Properties"):
-                devObj = dbus.SystemBus().get_object('org.freedesktop.NetworkManager', odev)
-                intf = devObj.Get("org.freedesktop.NetworkManager.Device", "IpInterface", dbus_interface="org.freedesktop.DBus.Properties")
-                newIntfSet.add(intf)
+            if self.backend is None or self.param.hostNetworkDebounceTime <= 0:
+                # the initial set is applied immediately
+                self._flush()
+            elif self.flushHandler is None:
+                self.flushHandler = GLib.timeout_add(self.param.hostNetworkDebounceTime, self._onFlushTimeout)
 
-        # delete interfaces
-        for ai in self.intfSet.difference(newIntfSet):
-            for cbObject in self.cbObjList:
-                cbObject.onActiveInterfaceRemove(ai)
-            self.intfSet.remove(ai)
+    def _onFlushTimeout(self):
+        with self.lock:
+            self.flushHandler = None
+            self._flush()
+        return False
+
+    def _flush(self):
+        addList = sorted(self.pendingIntfSet.difference(self.intfSet))
+        removeList = sorted(self.intfSet.difference(self.pendingIntfSet))
 
-        # add interfaces
-        for ai in newIntfSet.difference(self.intfSet):
+        self.deliveredCount += len(addList) + len(removeList)
+        self.suppressedCount += self.pendingChangeCount - len(addList) - len(removeList)
+        self.pendingChangeCount = 0
+        self.intfSet = set(self.pendingIntfSet)
+
+        if len(addList) > 0 or len(removeList) > 0:
             for cbObject in self.cbObjList:
-                cbObject.onActiveInterfaceAdd(ai)
-            self.intfSet.add(ai)
+                cbObject.onActiveInterfaceChange(addList, removeList)
 
 
 class VirtHostNetworkEventCallback:
 
     """Callback function of network event"""
 
+    def onActiveInterfaceChange(self, addList, removeList):
+        """Called once for a batch of changes, removed interfaces are processed before the added ones"""
+
+        for ifName in removeList:
+            self.onActiveInterfaceRemove(ifName)
+        for ifName in addList:
+            self.onActiveInterfaceAdd(ifName)
+
     def onActiveInterfaceAdd(self, ifName):
         assert False
 
     def onActiveInterfaceRemove(self, ifName):
         assert False
+
+
+class _BackendRtnetlink:
+
+    """Keeps the link table and the IPv4 default routes from RTNLGRP_LINK and RTNLGRP_IPV4_ROUTE notifications.
+       An event updates one entry and re-computes the active interface set from memory, no request is sent."""
+
+    def __init__(self, pObj):
+        self.pObj = pObj
+        self.marshal = MarshalRtnl()
+        self.linkDict = dict()             # { ifindex: (ifname, isUp) }
+        self.routeDict = dict()            # { routeKey: [oif, oif2, ...] }, IPv4 default routes only
+
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        try:
+            # bind the socket before dumping, so that no notification is lost
+            self.sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_ROUTE))
+            self.watch = GLib.io_add_watch(self.sock.fileno(), GLib.IO_IN, self._onEvent)
+            self._dump()
+        except:
+            self.sock.close()
+            raise
+
+    def release(self):
+        GLib.source_remove(self.watch)
+        self.sock.close()
+
+    def _dump(self):
+        self.linkDict = dict()
+        self.routeDict = dict()
+        for msg in self.pObj.param.netlink.getLinks():
+            self._processMsg(msg)
+        for msg in self.pObj.param.netlink.getIpv4Routes():
+            self._processMsg(msg)
+        self.pObj._updateIntfSet(self._getActiveIntfSet())
+
+    def _onEvent(self, source, cb_condition):
+        while True:
+            try:
+                buf = self.sock.recv(65536, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # notifications are lost, dump again
+                self._dump()
+                continue
+            for msg in self.marshal.parse(buf):
+                self._processMsg(msg)
+
+        self.pObj._updateIntfSet(self._getActiveIntfSet())
+        return True
+
+    def _processMsg(self, msg):
+        event = msg["event"]
+        if event == "RTM_NEWLINK":
+            isUp = (msg["flags"] & 0x1) != 0 and msg.get_attr("IFLA_OPERSTATE") in ["UP", "UNKNOWN"]     # IFF_UP
+            self.linkDict[msg["index"]] = (msg.get_attr("IFLA_IFNAME"), isUp)
+        elif event == "RTM_DELLINK":
+            self.linkDict.pop(msg["index"], None)
+        elif event in ["RTM_NEWROUTE", "RTM_DELROUTE"]:
+            if msg["dst_len"] != 0 or msg["type"] != 1:             # RTN_UNICAST
+                return
+            table = msg.get_attr("RTA_TABLE", msg["table"])
+            if table == 255:                                        # RT_TABLE_LOCAL
+                return
+
+            oifList = []
+            if msg.get_attr("RTA_OIF") is not None:
+                oifList.append(msg.get_attr("RTA_OIF"))
+            for nh in (msg.get_attr("RTA_MULTIPATH") or []):
+                oifList.append(nh["oif"])
+
+            key = (table, msg["tos"], msg.get_attr("RTA_PRIORITY", 0), tuple(oifList))
+            if event == "RTM_NEWROUTE":
+                self.routeDict[key] = oifList
+            else:
+                self.routeDict.pop(key, None)
+
+    def _getActiveIntfSet(self):
+        ret = set()
+        for oifList in self.routeDict.values():
+            for oif in oifList:
+                if oif in self.linkDict and self.linkDict[oif][1]:
+                    ret.add(self.linkDict[oif][0])
+        return ret
+
+
+class _BackendNetworkManager:
+
+    """Devices of the active connections of NetworkManager.
+       The interfaces of an active connection are fetched by GetAll() once when it appears, then they are cached,
+       signals which don't change the active connection list cost nothing."""
+
+    def __init__(self, pObj):
+        self.pObj = pObj
+        self.connDict = dict()             # { activeConnectionPath: set(ifname) }
+
+        self.nmObj = dbus.SystemBus().get_object('org.freedesktop.NetworkManager', '/org/freedesktop/NetworkManager')
+        self.handle = self.nmObj.connect_to_signal("PropertiesChanged", self._onPropertiesChanged, dbus_interface="org.freedesktop.NetworkManager")
+        self._update(self.nmObj.Get("org.freedesktop.NetworkManager", "ActiveConnections", dbus_interface="org.freedesktop.DBus.Properties"))
+
+    def release(self):
+        self.handle.remove()
+
+    def _onPropertiesChanged(self, props):
+        if 'ActiveConnections' not in props:
+            return
+        self._update(props['ActiveConnections'])
+
+    def _update(self, connPathList):
+        connPathList = [str(x) for x in connPathList]
+
+        for oconn in list(self.connDict.keys()):
+            if oconn not in connPathList:
+                del self.connDict[oconn]
+        for oconn in connPathList:
+            if oconn not in self.connDict:
+                self.connDict[oconn] = self._getConnIntfSet(oconn)
+
+        self.pObj._updateIntfSet(set().union(*self.connDict.values()))
+
+    def _getConnIntfSet(self, oconn):
+        ret = set()
+        try:
+            connObj = dbus.SystemBus().get_object('org.freedesktop.NetworkManager', oconn)
+            connProps = connObj.GetAll("org.freedesktop.NetworkManager.Connection.Active", dbus_interface="org.freedesktop.DBus.Properties")
+            for odev in connProps.get("Devices", []):
+                devObj = dbus.SystemBus().get_object('org.freedesktop.NetworkManager', odev)
+                devProps = devObj.GetAll("org.freedesktop.NetworkManager.Device", dbus_interface="org.freedesktop.DBus.Properties")
+                if devProps.get("IpInterface", "") != "":
+                    ret.add(str(devProps["IpInterface"]))
+        except dbus.exceptions.DBusException:
+            pass                           # the connection is deactivated in the mean time
+        return ret
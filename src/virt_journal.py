@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import json
+import threading
+
+
+class VirtJournal:
+
+    """Append-only journal of the daemon state, one JSON record per line.
+       A record adds or removes one object, objects are identified by their type and key fields:
+         resset:   uid, sid               (other fields: owner)
+         network:  uid, network           (other fields: nid)
+         tap:      uid, network, sid      (other fields: tap, queues, vnetHdr, offloads)
+         share:    vmip, name             (other fields: uid, path, readonly)
+       The state is rebuilt by replaying the records at startup, so that a new daemon instance
+       can re-adopt the kernel objects created by the previous one instead of re-creating them.
+       The file is rewritten as a snapshot of the state when it is much longer than the state."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.state = dict()             # { type: { key: fieldDict } }
+        self.recordCount = 0            # number of records in file
+        self.fd = None
+        self.lock = threading.Lock()    # records are added in worker threads
+
+        for t in _typeKeyDict:
+            self.state[t] = dict()
+
+        if os.path.exists(self.filename):
+            with open(self.filename, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break           # the last record is incomplete if the previous instance crashed when writing it
+                    self._apply(record)
+
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        self._compact()
+
+    def release(self):
+        os.close(self.fd)
+        self.fd = None
+
+        # nothing is left in a clean shutdown, the next instance needs not to restore anything
+        if self.isEmpty():
+            os.unlink(self.filename)
+
+    def isEmpty(self):
+        with self.lock:
+            return all(len(x) == 0 for x in self.state.values())
+
+    def getList(self, objType):
+        """Returns the field dicts of all the objects of the specified type"""
+
+        with self.lock:
+            return [dict(x) for x in self.state[objType].values()]
+
+    def add(self, objType, **kwargs):
+        self._append(dict(kwargs, op="add", type=objType))
+
+    def remove(self, objType, **kwargs):
+        self._append(dict(kwargs, op="remove", type=objType))
+
+    def _append(self, record):
+        with self.lock:
+            self._apply(record)
+
+            # one write() for each record, so that a record is never interleaved with others
+            os.write(self.fd, (json.dumps(record, sort_keys=True) + "\n").encode("utf-8"))
+
+            if self.recordCount > 2 * sum(len(x) for x in self.state.values()) + 128:
+                self._compact()
+
+    def _apply(self, record):
+        objType = record["type"]
+        key = tuple(record[k] for k in _typeKeyDict[objType])
+        if record["op"] == "add":
+            self.state[objType][key] = {k: v for k, v in record.items() if k not in ["op", "type"]}
+        elif record["op"] == "remove":
+            self.state[objType].pop(key, None)
+        else:
+            assert False
+        self.recordCount += 1
+
+    def _compact(self):
+        # write snapshot to a new file and rename it, so that the journal is always complete on disk
+        buf = ""
+        count = 0
+        for objType in _typeKeyDict:
+            for fields in self.state[objType].values():
+                buf += json.dumps(dict(fields, op="add", type=objType), sort_keys=True) + "\n"
+                count += 1
+
+        tmpFilename = self.filename + ".new"
+        with open(tmpFilename, "w") as f:
+            f.write(buf)
+        os.rename(tmpFilename, self.filename)
+
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND)
+        self.recordCount = count
+
+
+# object type and key fields, in dependency order
+_typeKeyDict = {
+    "resset": ["uid", "sid"],
+    "network": ["uid", "network"],
+    "tap": ["uid", "network", "sid"],
+    "share": ["vmip", "name"],
+}
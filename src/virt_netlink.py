@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import errno
+import socket
+import threading
+import pyroute2
+from pyroute2.netlink import NLM_F_REQUEST
+from pyroute2.netlink import NLM_F_ACK
+from pyroute2.netlink import NLMSG_ERROR
+from pyroute2.netlink.rtnl import RTMGRP_LINK
+from pyroute2.netlink.rtnl import RTM_NEWLINK
+from pyroute2.netlink.rtnl import RTM_DELLINK
+from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
+from pyroute2.netlink.rtnl.marshal import MarshalRtnl
+from gi.repository import GLib
+from virt_util import VirtUtil
+
+
+class VirtNetlink:
+
+    """The rtnetlink session shared by the whole daemon.
+       An interface name to index cache is maintained from RTM_NEWLINK/RTM_DELLINK notifications."""
+
+    def __init__(self):
+        self.ip = None
+        self.monitor = None
+        self.monitorMarshal = MarshalRtnl()
+        self.monitorWatch = None
+        self.ifindexDict = dict()             # { ifname: ifindex }
+        self.lock = threading.RLock()         # requests come from worker threads, notifications are processed in main loop
+
+        try:
+            self.ip = pyroute2.IPRoute()
+
+            # bind the monitor socket before dumping, so that no notification is lost
+            # we use a raw socket so that every readable event is processed completely in one callback
+            self.monitor = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            self.monitor.bind((0, RTMGRP_LINK))
+            self.monitorWatch = GLib.io_add_watch(self.monitor.fileno(), GLib.IO_IN, self._onMonitorEvent)
+
+            self._fillCache()
+        except:
+            self.release()
+            raise
+
+    def release(self):
+        if self.monitorWatch is not None:
+            GLib.source_remove(self.monitorWatch)
+            self.monitorWatch = None
+        if self.monitor is not None:
+            self.monitor.close()
+            self.monitor = None
+        if self.ip is not None:
+            self.ip.close()
+            self.ip = None
+        self.ifindexDict = dict()
+
+    def linkLookup(self, ifname):
+        """Returns interface index, returns None if the interface does not exist"""
+
+        with self.lock:
+            ret = self.ifindexDict.get(ifname, None)
+            if ret is not None:
+                return ret
+
+            # the interface may be created just now and its notification is not processed yet,
+            # so we query this interface only, instead of dumping the whole link table
+            try:
+                ret = self.ip.link("get", ifname=ifname)[0]["index"]
+            except pyroute2.NetlinkError:
+                return None
+            self.ifindexDict[ifname] = ret
+            return ret
+
+    def addBridge(self, ifname):
+        with self.lock:
+            self.ip.link("add", kind="bridge", ifname=ifname)
+            return self.linkLookup(ifname)
+
+    def addTap(self, ifname, uid, gid, multiQueue=False, vnetHdr=False, offloads=[]):
+        with self.lock:
+            VirtUtil.createTapInterface(ifname, uid, gid, multiQueue, vnetHdr, offloads)
+            self.ifindexDict.pop(ifname, None)          # the interface name may be re-used, drop the stale entry
+            return self.linkLookup(ifname)
+
+    def delTap(self, ifname):
+        with self.lock:
+            # RTM_DELLINK works for all kinds of tap interface, no matter which flags they are created with
+            self.delLink(ifname)
+
+    def delLink(self, ifname):
+        with self.lock:
+            idx = self._getIndex(ifname)
+            self.ip.link("del", index=idx)
+            if self.ifindexDict.get(ifname, None) == idx:
+                del self.ifindexDict[ifname]
+
+    def delLinks(self, ifnameList):
+        """Deletes many interfaces in one go, interfaces that don't exist are ignored.
+           The interfaces are moved into a dedicated interface group by one batch of requests, then the whole group
+           is deleted by one RTM_DELLINK, so that the kernel waits one RCU grace period instead of one for each interface."""
+
+        with self.lock:
+            idxList = [self.ifindexDict[x] for x in ifnameList if x in self.ifindexDict]
+            if len(idxList) == 0:
+                return
+
+            s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            try:
+                s.bind((0, 0))
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+                for i in range(0, len(idxList), _batchSize):
+                    _sendBatch(s, [_linkGroupMsg(RTM_NEWLINK, x, _deleteGroup) for x in idxList[i:i + _batchSize]])
+                _sendBatch(s, [_linkGroupMsg(RTM_DELLINK, 0, _deleteGroup)])
+            finally:
+                s.close()
+
+            for ifname in ifnameList:
+                self.ifindexDict.pop(ifname, None)
+
+    def setLinkUp(self, ifname):
+        with self.lock:
+            self.ip.link("set", index=self._getIndex(ifname), state="up")
+
+    def setLinkDown(self, ifname):
+        with self.lock:
+            self.ip.link("set", index=self._getIndex(ifname), state="down")
+
+    def setLinkAddress(self, ifname, macaddr):
+        with self.lock:
+            self.ip.link("set", index=self._getIndex(ifname), address=macaddr)
+
+    def addAddress(self, ifname, ipaddr, prefixlen, broadcast):
+        with self.lock:
+            self.ip.addr("add", index=self._getIndex(ifname), address=ipaddr, mask=prefixlen, broadcast=broadcast)
+
+    def getLinks(self):
+        """Returns RTM_NEWLINK messages of all the interfaces"""
+
+        with self.lock:
+            return list(self.ip.get_links())
+
+    def getIpv4Routes(self):
+        """Returns RTM_NEWROUTE messages of all the IPv4 routes in all tables"""
+
+        with self.lock:
+            return list(self.ip.get_routes(family=socket.AF_INET))
+
+    def _getIndex(self, ifname):
+        ret = self.linkLookup(ifname)
+        if ret is None:
+            raise Exception("interface %s not found" % (ifname))
+        return ret
+
+    def _fillCache(self):
+        self.ifindexDict = dict()
+        for msg in self.ip.get_links():
+            self.ifindexDict[msg.get_attr("IFLA_IFNAME")] = msg["index"]
+
+    def _onMonitorEvent(self, source, cb_condition):
+        with self.lock:
+            return self._processMonitorEvent()
+
+    def _processMonitorEvent(self):
+        # process all the pending notifications in one go, so that the cache is
+        # never left in an intermediate state, such as "deleted, but not re-created yet"
+        while True:
+            try:
+                buf = self.monitor.recv(65536, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # notifications are lost, re-fill the cache
+                self._fillCache()
+                continue
+
+            for msg in self.monitorMarshal.parse(buf):
+                ifname = msg.get_attr("IFLA_IFNAME")
+                if ifname is None:
+                    continue
+                if msg["event"] == "RTM_NEWLINK":
+                    self.ifindexDict[ifname] = msg["index"]
+                elif msg["event"] == "RTM_DELLINK":
+                    # the name may have been re-used by a new interface
+                    if self.ifindexDict.get(ifname, None) == msg["index"]:
+                        del self.ifindexDict[ifname]
+        return True
+
+
+_deleteGroup = 0x76697274           # interface group used by VirtNetlink.delLinks()
+_batchSize = 256                    # number of requests in one netlink batch
+
+
+def _linkGroupMsg(msgType, ifindex, group):
+    msg = ifinfmsg()
+    msg["family"] = socket.AF_UNSPEC
+    msg["index"] = ifindex
+    msg["attrs"] = [("IFLA_GROUP", group)]
+    msg["header"]["type"] = msgType
+    msg["header"]["flags"] = NLM_F_REQUEST | NLM_F_ACK
+    msg.encode()
+    return msg.data
+
+
+def _sendBatch(s, msgList):
+    # send all the requests in one system call, then collect one acknowledgement for each of them
+    # ENODEV is ignored, the interface may have been deleted by others
+    s.send(b"".join(msgList))
+
+    count = 0
+    marshal = MarshalRtnl()
+    while count < len(msgList):
+        for msg in marshal.parse(s.recv(65536)):
+            if msg["header"]["type"] != NLMSG_ERROR:
+                continue
+            count += 1
+            e = msg["header"].get("error", None)
+            if e is not None and e.code != errno.ENODEV:
+                raise e
@@ -3,11 +3,16 @@
 
 import os
 import re
+import pwd
 import shutil
-import pyroute2
+import errno
+import threading
 import ipaddress
+from gi.repository import GLib
 from virt_util import VirtUtil
+from virt_util import VirtIdAllocator
 from virt_param import VirtInitializationError
+from virt_dhcp_server import VirtDhcpServer
 from virt_host_network import VirtHostNetworkEventCallback
 
 
@@ -16,70 +21,162 @@ class VirtNetworkManager:
     def __init__(self, param):
         self.param = param
         self.netDict = dict()       # { userId: { netName: netObj, netName2: netObj2, ... }, userId2: { ... }, ... }
+        self.nidDict = dict()       # { nid: netObj, nid2: netObj2, ... }, has the same content as self.netDict
+        self.nidAllocator = VirtIdAllocator(1, 256 * 256 - 1)
+        self.netLockDict = dict()   # { (userId, netName): lock }
+        self.lock = threading.Lock()
 
-        if not os.path.exists("/bin/ip"):
-            raise VirtInitializationError("/bin/ip not found")
-        if not os.path.exists("/sbin/nft"):
-            raise VirtInitializationError("/sbin/nft not found")
+        if not os.path.exists("/dev/net/tun"):
+            raise VirtInitializationError("/dev/net/tun not found")
 
     def release(self):
         assert len(self.netDict) == 0
+        assert len(self.nidDict) == 0
+
+    def removeStaleObjects(self):
+        """Removes the bridges, tap interfaces and nat table left behind by crashed daemon instances which are not
+           recorded in the journal, and all the stale dnsmasq processes, called once at startup before restore().
+           Links are looked up in the netlink cache, which is filled by one link dump, and deleted in one batch."""
+
+        networkRecordList = self.param.journal.getList("network")
+        brnameList = ["vnb%d" % (x["nid"]) for x in networkRecordList]
+        keepSet = set(brnameList) | set(x["tap"] for x in self.param.journal.getList("tap"))
+
+        staleList = []
+        for ifname in list(self.param.netlink.ifindexDict.keys()):
+            if re.fullmatch("vnb[0-9]+(\\.[0-9]+)?", ifname) is not None and ifname not in keepSet:
+                staleList.append(ifname)
+        self.param.netlink.delLinks(staleList)
+
+        if not any(x["network"] == "nat" for x in networkRecordList):
+            self.param.nftables.natRemoveStale()
+
+        VirtDhcpServer.removeStaleServers(self.param)
+
+    def restore(self):
+        """Re-adopts the networks and tap interfaces recorded in the journal by the previous daemon instance.
+           Existing bridges and tap interfaces are used as is, missing ones are re-created."""
+
+        tapRecordList = self.param.journal.getList("tap")
+        restoredList = []
+        for record in self.param.journal.getList("network"):
+            uid, networkName, nid = record["uid"], record["network"], record["nid"]
+
+            self.nidAllocator.markUsed(nid)
+            nobj = self._newNetworkObject(uid, networkName, nid, True)
+            if uid not in self.netDict:
+                self.netDict[uid] = dict()
+            self.netDict[uid][networkName] = nobj
+            self.nidDict[nid] = nobj
+
+            # each tap interface holds a reference, see DbusResSetObject._addTapIntf()
+            for tr in tapRecordList:
+                if tr["uid"] == uid and tr["network"] == networkName:
+                    options = VirtTapOptions(tr["queues"], tr["vnetHdr"], tr["offloads"])
+                    nobj.adoptTapIntf(tr["sid"], tr["tap"], options)
+                    nobj.refcount += 1
+            restoredList.append((uid, networkName, nobj))
+
+        # masquerade of all the restored nat networks is set up in one nftables transaction
+        natList = [(x.netip, VirtUtil.ipMaskToLen(x.netmask)) for u, n, x in restoredList if isinstance(x, _NetworkNat)]
+        if len(natList) > 0:
+            self.param.nftables.natAddNetworks(natList)
+
+        for uid, networkName, nobj in restoredList:
+            if nobj.refcount == 0:
+                nobj.refcount = 1
+                self.removeNetwork(uid, networkName)
+
+        # samba is started on the networks which have shares, the shares are restored by VirtSambaServer.restore()
+        nidSet = set(_getNidByIp(x["vmip"]) for x in self.param.journal.getList("share"))
+        for uid, networkName, nobj in restoredList:
+            if nobj.refcount > 0 and nobj.nid in nidSet:
+                nobj.startSambaServer()
+
+        if len(self.netDict) > 0:
+            VirtUtil.writeFile("/proc/sys/net/ipv4/ip_forward", "1")
+
+    def getNetworkLock(self, uid, networkName):
+        """Operations on the same network must be serialized by this lock, operations on different networks can run in parallel.
+           Caller of addNetwork(), removeNetwork(), addTapIntf(), removeTapIntf() and startSambaServer() must hold it."""
+
+        assert _validateNetworkName(networkName)
+        with self.lock:
+            key = (uid, networkName)
+            if key not in self.netLockDict:
+                self.netLockDict[key] = threading.Lock()
+            return self.netLockDict[key]
 
     def addNetwork(self, uid, networkName):
         assert _validateNetworkName(networkName)
 
-        if uid in self.netDict and networkName in self.netDict[uid]:
-            # network object already exists, add reference count
-            self.netDict[uid][networkName].refcount += 1
-        else:
-            # create a new network object
+        with self.lock:
+            if uid in self.netDict and networkName in self.netDict[uid]:
+                # network object already exists, add reference count
+                self.netDict[uid][networkName].refcount += 1
+                return
+            nid = self.nidAllocator.alloc()
+
+        # create a new network object, it's slow, so self.lock is not held
+        try:
+            nobj = self._newNetworkObject(uid, networkName, nid, False)
+        except:
+            with self.lock:
+                self.nidAllocator.free(nid)
+            raise
+
+        with self.lock:
+            nobj.refcount += 1
             if uid not in self.netDict:
                 self.netDict[uid] = dict()
-            try:
-                if networkName == "bridge":
-                    nobj = _NetworkBridge(self.param, uid, self._allocId())
-                elif networkName == "nat":
-                    nobj = _NetworkNat(self.param, uid, self._allocId())
-                elif networkName == "route":
-                    nobj = _NetworkRoute(self.param, uid, self._allocId())
-                elif networkName == "isolate":
-                    nobj = _NetworkIsolate(self.param, uid, self._allocId())
-                else:
-                    assert False
-                nobj.refcount += 1
-                self.netDict[uid][networkName] = nobj
-
-                # open ipv4 forwarding, currently no other program needs it, so we do a simple implementation
-                VirtUtil.writeFile("/proc/sys/net/ipv4/ip_forward", "1")
-            except:
-                if len(self.netDict[uid]) == 0:
-                    del self.netDict[uid]
-                raise
+            self.netDict[uid][networkName] = nobj
+            self.nidDict[nid] = nobj
+
+            # open ipv4 forwarding, currently no other program needs it, so we do a simple implementation
+            VirtUtil.writeFile("/proc/sys/net/ipv4/ip_forward", "1")
+
+        self.param.journal.add("network", uid=uid, network=networkName, nid=nid)
 
     def removeNetwork(self, uid, networkName):
         assert _validateNetworkName(networkName)
 
-        if uid not in self.netDict or networkName not in self.netDict[uid]:
-            return
+        with self.lock:
+            if uid not in self.netDict or networkName not in self.netDict[uid]:
+                return
+
+            nobj = self.netDict[uid][networkName]
+            nobj.refcount -= 1
+            if nobj.refcount > 0:
+                return
 
-        nobj = self.netDict[uid][networkName]
-        nobj.refcount -= 1
-        if nobj.refcount == 0:
-            nobj.release()
             del self.netDict[uid][networkName]
+            del self.nidDict[nobj.nid]
             if len(self.netDict[uid]) == 0:
                 del self.netDict[uid]
+
+        # nid is freed after the network object is released, so that it won't be re-used too early
+        nobj.release()
+        self.param.journal.remove("network", uid=uid, network=networkName)
+
+        with self.lock:
+            self.nidAllocator.free(nobj.nid)
             if len(self.netDict) == 0:
                 VirtUtil.writeFile("/proc/sys/net/ipv4/ip_forward", "0")
 
-    def addTapIntf(self, uid, networkName, sid):
+    def addTapIntf(self, uid, networkName, sid, options=None):
         assert _validateNetworkName(networkName) and _validateResSetId(sid)
-        self.netDict[uid][networkName].addTapIntf(sid)
+        if options is None:
+            options = VirtTapOptions()
+        nobj = self.netDict[uid][networkName]
+        nobj.addTapIntf(sid, options)
+        self.param.journal.add("tap", uid=uid, network=networkName, sid=sid, tap=nobj.getTapInterface(sid),
+                               queues=options.queues, vnetHdr=options.vnetHdr, offloads=options.offloads)
 
     def removeTapIntf(self, uid, networkName, sid):
         assert _validateNetworkName(networkName) and _validateResSetId(sid)
         if self.netDict[uid][networkName].getTapInterface(sid) is not None:
             self.netDict[uid][networkName].removeTapIntf(sid)
+            self.param.journal.remove("tap", uid=uid, network=networkName, sid=sid)
 
     def hasTapIntf(self, uid, networkName, sid):
         assert _validateNetworkName(networkName) and _validateResSetId(sid)
@@ -93,6 +190,34 @@ class VirtNetworkManager:
         assert ret is not None
         return ret
 
+    def getTapIntfOptions(self, uid, networkName, sid):
+        assert _validateNetworkName(networkName) and _validateResSetId(sid)
+        ret = self.netDict[uid][networkName].getTapInterfaceOptions(sid)
+        assert ret is not None
+        return ret
+
+    def openTapIntfQueues(self, uid, networkName, sid):
+        """Returns a file descriptor list, one for each queue, caller should close them"""
+
+        tapname = self.getTapIntf(uid, networkName, sid)
+        options = self.getTapIntfOptions(uid, networkName, sid)
+
+        ret = []
+        try:
+            for i in range(0, options.queues):
+                ret.append(VirtUtil.openTapQueue(tapname, options.queues > 1, options.vnetHdr))
+            return ret
+        except:
+            for fd in ret:
+                os.close(fd)
+            raise
+
+    def startSambaServer(self, uid, networkName):
+        """Returns False if the network doesn't support samba shares"""
+
+        assert _validateNetworkName(networkName)
+        return self.netDict[uid][networkName].startSambaServer()
+
     def getVmIp(self, uid, networkName, sid):
         assert _validateNetworkName(networkName)
         return self.netDict[uid][networkName].getVmIp(sid)
@@ -101,19 +226,42 @@ class VirtNetworkManager:
         assert _validateNetworkName(networkName)
         return self.netDict[uid][networkName].getVmMac(sid)
 
-    def _allocId(self):
-        for nid in range(1, 256 * 256):
-            found = False
-            for netu in list(self.netDict.values()):
-                for net in list(netu.values()):
-                    if net.nid == nid:
-                        found = True
-                        break
-                if found:
-                    break
-            if not found:
-                return nid
-        assert False
+    def getNetworkTmpDir(self, uid, networkName):
+        assert _validateNetworkName(networkName)
+        return self.netDict[uid][networkName].getTmpDir()
+
+    def getNetworkById(self, nid):
+        """For diagnostics, returns None if not found"""
+        return self.nidDict.get(nid, None)
+
+    def _newNetworkObject(self, uid, networkName, nid, adopt):
+        if networkName == "bridge":
+            return _NetworkBridge(self.param, uid, nid, adopt)
+        elif networkName == "nat":
+            return _NetworkNat(self.param, uid, nid, adopt)
+        elif networkName == "route":
+            return _NetworkRoute(self.param, uid, nid)
+        elif networkName == "isolate":
+            return _NetworkIsolate(self.param, uid, nid)
+        else:
+            assert False
+
+
+class VirtTapOptions:
+
+    """Options of tap interface, queues > 1 means a multi-queue tap interface"""
+
+    def __init__(self, queues=1, vnetHdr=False, offloads=[]):
+        assert 1 <= queues <= 256
+        assert all(x in ["csum", "tso4", "tso6", "tso_ecn", "ufo"] for x in offloads)
+        assert vnetHdr or len(offloads) == 0
+
+        self.queues = queues
+        self.vnetHdr = vnetHdr
+        self.offloads = list(offloads)
+
+    def isDefault(self):
+        return self.queues == 1 and not self.vnetHdr and len(self.offloads) == 0
 
 
 class _NetworkBase:
@@ -146,35 +294,56 @@ class _NetworkBase:
         assert _validateResSetId(sid)
         return "%s:%02x:%02x:%02x" % (self.macOui, self.nid // 256, self.nid % 256, self.minIpNumber + sid)
 
+    def startSambaServer(self):
+        """Samba is started on the network when the first share is added, so that the network works on hosts without samba.
+           Returns False if the network doesn't support samba shares."""
+        return False
+
 
 class _NetworkBridge(_NetworkBase, VirtHostNetworkEventCallback):
 
-    def __init__(self, param, uid, nid):
+    def __init__(self, param, uid, nid, adopt=False):
+        _initSubsystems(param, ["hostNetwork"])
         super(_NetworkBridge, self).__init__(param, uid, nid)
 
         self.brname = "vnb%d" % (self.nid)
         self.mainIntfList = []
         self.tapDict = dict()
-
-        with pyroute2.IPRoute() as ip:
-            ip.link("add", kind="bridge", ifname=self.brname)
-            idx = ip.link_lookup(ifname=self.brname)[0]
-            ip.link("set", index=idx, state="up")
-        self.param.hostNetwork.registerEventCallback(self)
+        self.tapOptionsDict = dict()
+        self.tapIdAllocator = _newTapIdAllocator(self.param, self.brname)
+
+        bridgeCreated = False
+        callbackRegistered = False
+        try:
+            if not _adoptBridge(self, adopt):
+                self.param.netlink.addBridge(self.brname)
+                bridgeCreated = True
+            self.param.netlink.setLinkUp(self.brname)
+            callbackRegistered = True
+            self.param.hostNetwork.registerEventCallback(self)
+            self.tapPool = _newTapPool(self)
+        except:
+            if callbackRegistered:
+                self.param.hostNetwork.unregisterEventCallback(self)
+            if bridgeCreated:
+                self.param.netlink.delLink(self.brname)
+            super(_NetworkBridge, self).release()
+            raise
 
     def release(self):
         assert len(self.tapDict) == 0
+        if self.tapPool is not None:
+            self.tapPool.release()
         self.param.hostNetwork.unregisterEventCallback(self)
-        with pyroute2.IPRoute() as ip:
-            idx = ip.link_lookup(ifname=self.brname)[0]
-            ip.link("set", index=idx, state="down")
-            ip.link("del", index=idx)
+        self.param.netlink.setLinkDown(self.brname)
+        self.param.netlink.delLink(self.brname)
         super(_NetworkBridge, self).release()
 
     def onActiveInterfaceAdd(self, ifName):
         # some interface like wlan0 has no bridging capbility, we ignore them
         # fixme: how to send this error to user?
-        VirtUtil.addInterfaceToBridge(self.brname, ifName)
+        if _getBridgeMaster(ifName) != self.brname:          # it is enslaved already if the bridge is adopted
+            VirtUtil.addInterfaceToBridge(self.brname, ifName)
         self.mainIntfList.append(ifName)
 
     def onActiveInterfaceRemove(self, ifName):
@@ -182,35 +351,43 @@ class _NetworkBridge(_NetworkBase, VirtHostNetworkEventCallback):
             VirtUtil.removeInterfaceFromBridge(self.brname, ifName)
             self.mainIntfList.remove(ifName)
 
-    def addTapIntf(self, sid):
+    def addTapIntf(self, sid, options):
+        assert sid not in self.tapDict
+
+        tapname = None
+        if self.tapPool is not None and options.isDefault():
+            tapname = self.tapPool.get()
+        if tapname is None:
+            tapname = _createBridgedTap(self, options)
+        self.tapDict[sid] = tapname
+        self.tapOptionsDict[sid] = options
+
+    def adoptTapIntf(self, sid, tapname, options):
         assert sid not in self.tapDict
 
-        tapname = "%s.%d" % (self.brname, VirtUtil.getMaxTapId(self.brname) + 1)
-        VirtUtil.shell('/bin/ip tuntap add dev "%s" mode tap' % (tapname))
-        VirtUtil.addInterfaceToBridge(self.brname, tapname)
-        with pyroute2.IPRoute() as ip:
-            idx = ip.link_lookup(ifname=tapname)[0]
-            ip.link("set", index=idx, state="up")
+        _adoptBridgedTap(self, tapname, options)
         self.tapDict[sid] = tapname
+        self.tapOptionsDict[sid] = options
 
     def removeTapIntf(self, sid):
         assert sid in self.tapDict
 
         tapname = self.tapDict[sid]
-        with pyroute2.IPRoute() as ip:
-            idx = ip.link_lookup(ifname=tapname)[0]
-            ip.link("set", index=idx, state="down")
-        VirtUtil.removeInterfaceFromBridge(self.brname, tapname)
-        VirtUtil.shell('/bin/ip tuntap del dev "%s" mode tap' % (tapname))
+        _deleteBridgedTap(self, tapname)
         del self.tapDict[sid]
+        del self.tapOptionsDict[sid]
 
     def getTapInterface(self, sid):
         return self.tapDict.get(sid, None)
 
+    def getTapInterfaceOptions(self, sid):
+        return self.tapOptionsDict.get(sid, None)
+
 
 class _NetworkNat(_NetworkBase, VirtHostNetworkEventCallback):
 
-    def __init__(self, param, uid, nid):
+    def __init__(self, param, uid, nid, adopt=False):
+        _initSubsystems(param, ["dhcpServer", "hostNetwork"])
         super(_NetworkNat, self).__init__(param, uid, nid)
 
         self.netip = "10.%d.%d.0" % (self.nid // 256, self.nid % 256)
@@ -222,32 +399,52 @@ class _NetworkNat(_NetworkBase, VirtHostNetworkEventCallback):
 
         self.mainIntfList = []
         self.tapDict = dict()
-
-        with pyroute2.IPRoute() as ip:
-            brnet = ipaddress.IPv4Network(self.brip + "/" + self.netmask, strict=False)
-            ip.link("add", kind="bridge", ifname=self.brname)
-            idx = ip.link_lookup(ifname=self.brname)[0]
-            ip.link('set', index=idx, address='00:11:22:33:44:55')
-            ip.addr("add", index=idx, address=str(self.brip), mask=brnet.prefixlen, broadcast=str(brnet.broadcast_address))
-            ip.link("set", index=idx, state="up")
-        self._addNftNatRule(self.netip, self.netmask)
-
-        self.param.dhcpServer.startOnNetwork(self)
-        self.param.sambaServer.startOnNetwork(uid, self)
-        self.param.hostNetwork.registerEventCallback(self)
+        self.tapOptionsDict = dict()
+        self.tapIdAllocator = _newTapIdAllocator(self.param, self.brname)
+        self.sambaStarted = False
+
+        bridgeCreated = False
+        natRuleAdded = False
+        dhcpStarted = False
+        try:
+            if not _adoptBridge(self, adopt):
+                brnet = ipaddress.IPv4Network(self.brip + "/" + self.netmask, strict=False)
+                self.param.netlink.addBridge(self.brname)
+                bridgeCreated = True
+                self.param.netlink.setLinkAddress(self.brname, '00:11:22:33:44:55')
+                self.param.netlink.addAddress(self.brname, str(self.brip), brnet.prefixlen, str(brnet.broadcast_address))
+            self.param.netlink.setLinkUp(self.brname)
+            if not adopt:
+                self._addNftNatRule(self.netip, self.netmask)       # restored networks are added in one batch by VirtNetworkManager.restore()
+                natRuleAdded = True
+
+            self.param.dhcpServer.startOnNetwork(self)
+            dhcpStarted = True
+            self.param.hostNetwork.registerEventCallback(self)
+            self.tapPool = _newTapPool(self)
+        except:
+            if dhcpStarted:
+                self.param.dhcpServer.stopOnNetwork(self)
+            if natRuleAdded:
+                self._removeNftNatRule(self.netip, self.netmask)
+            if bridgeCreated:
+                self.param.netlink.delLink(self.brname)
+            super(_NetworkNat, self).release()
+            raise
 
     def release(self):
         assert len(self.tapDict) == 0
 
+        if self.tapPool is not None:
+            self.tapPool.release()
         self.param.hostNetwork.unregisterEventCallback(self)
-        self.param.sambaServer.stopOnNetwork(self)
+        if self.sambaStarted:
+            self.param.sambaServer.stopOnNetwork(self)
         self.param.dhcpServer.stopOnNetwork(self)
 
         self._removeNftNatRule(self.netip, self.netmask)
-        with pyroute2.IPRoute() as ip:
-            idx = ip.link_lookup(ifname=self.brname)[0]
-            ip.link("set", index=idx, state="down")
-            ip.link("del", index=idx)
+        self.param.netlink.setLinkDown(self.brname)
+        self.param.netlink.delLink(self.brname)
 
         super(_NetworkNat, self).release()
 
@@ -257,76 +454,152 @@ class _NetworkNat(_NetworkBase, VirtHostNetworkEventCallback):
     def onActiveInterfaceRemove(self, ifName):
         self.mainIntfList.remove(ifName)
 
-    def addTapIntf(self, sid):
+    def addTapIntf(self, sid, options):
+        assert sid not in self.tapDict
+
+        tapname = None
+        if self.tapPool is not None and options.isDefault():
+            tapname = self.tapPool.get()
+        if tapname is None:
+            tapname = _createBridgedTap(self, options)
+        try:
+            self.param.dhcpServer.addHost(self, sid)
+        except:
+            _deleteBridgedTap(self, tapname)
+            raise
+        self.tapDict[sid] = tapname
+        self.tapOptionsDict[sid] = options
+
+    def adoptTapIntf(self, sid, tapname, options):
         assert sid not in self.tapDict
 
-        tapname = "%s.%d" % (self.brname, VirtUtil.getMaxTapId(self.brname) + 1)
-        VirtUtil.shell('/bin/ip tuntap add dev "%s" mode tap' % (tapname))
-        VirtUtil.addInterfaceToBridge(self.brname, tapname)
-        with pyroute2.IPRoute() as ip:
-            idx = ip.link_lookup(ifname=tapname)[0]
-            ip.link("set", index=idx, state="up")
+        _adoptBridgedTap(self, tapname, options)
+        self.param.dhcpServer.addHost(self, sid)
         self.tapDict[sid] = tapname
+        self.tapOptionsDict[sid] = options
 
     def removeTapIntf(self, sid):
         assert sid in self.tapDict
 
         tapname = self.tapDict[sid]
-        with pyroute2.IPRoute() as ip:
-            idx = ip.link_lookup(ifname=tapname)[0]
-            ip.link("set", index=idx, state="down")
-        VirtUtil.removeInterfaceFromBridge(self.brname, tapname)
-        VirtUtil.shell('/bin/ip tuntap del dev "%s" mode tap' % (tapname))
+        self.param.dhcpServer.removeHost(self, sid)
+        _deleteBridgedTap(self, tapname)
         del self.tapDict[sid]
+        del self.tapOptionsDict[sid]
 
     def getTapInterface(self, sid):
         return self.tapDict.get(sid, None)
 
-    def _addNftNatRule(self, netip, netmask):
-        # create table
-        rc, msg = VirtUtil.shell('/sbin/nft list table ip virt-service-nat', "retcode+stdout")
-        if rc != 0:
-            VirtUtil.shell('/sbin/nft add table ip virt-service-nat')
-            VirtUtil.shell('/sbin/nft add chain virt-service-nat prerouting { type nat hook prerouting priority 0 \\; }')
-            VirtUtil.shell('/sbin/nft add chain virt-service-nat postrouting { type nat hook postrouting priority 0 \\; }')
+    def getTapInterfaceOptions(self, sid):
+        return self.tapOptionsDict.get(sid, None)
 
-        # create rule
-        VirtUtil.shell('/sbin/nft add rule virt-service-nat postrouting ip saddr %s/%s masquerade' % (netip, VirtUtil.ipMaskToLen(netmask)))
+    def startSambaServer(self):
+        if not self.sambaStarted:
+            self.param.sambaServer.startOnNetwork(self.uid, self)
+            self.sambaStarted = True
+        return True
+
+    def _addNftNatRule(self, netip, netmask):
+        self.param.nftables.natAddNetwork(netip, VirtUtil.ipMaskToLen(netmask))
 
     def _removeNftNatRule(self, netip, netmask):
-        # table must be there
-        rc, msg = VirtUtil.shell('/sbin/nft list table ip virt-service-nat', "retcode+stdout")
-        assert rc == 0
+        self.param.nftables.natRemoveNetwork(netip, VirtUtil.ipMaskToLen(netmask))
+
 
-        # delete my rule
-        msg = VirtUtil.shell('/sbin/nft list table ip virt-service-nat -a', "stdout")
-        m = re.search("^.* %s/%s .* # handle ([0-9]+)$" % (netip, VirtUtil.ipMaskToLen(netmask)), msg, re.M)
-        if m is not None:
-            VirtUtil.shell('/sbin/nft delete rule virt-service-nat postrouting handle %s' % (m.group(1)))
+class _TapPool:
 
-        # delete table if no rules left
-        msg = VirtUtil.shell('/sbin/nft list table ip virt-service-nat -a', "stdout")
-        m = re.search("handle [0-9]+", msg, re.M)
-        if m is None:
-            VirtUtil.shell('/sbin/nft delete table virt-service-nat')
+    """Keeps tap interfaces which are created, enslaved to the bridge and up, so that they can be handed out immediately.
+       The pool is refilled to the high watermark in the main loop when it drops below the low watermark."""
+
+    def __init__(self, netObj, lowWatermark, highWatermark):
+        assert 0 <= lowWatermark <= highWatermark and highWatermark > 0
+
+        self.netObj = netObj
+        self.lowWatermark = lowWatermark
+        self.highWatermark = highWatermark
+        self.tapList = []
+        self.refillHandler = None
+        self.lock = threading.Lock()          # get() is called in worker threads, refilling is done in main loop
+
+        self._scheduleRefill()
+
+    def release(self):
+        with self.lock:
+            if self.refillHandler is not None:
+                GLib.source_remove(self.refillHandler)
+                self.refillHandler = None
+            for tapname in self.tapList:
+                _deleteBridgedTap(self.netObj, tapname)
+            self.tapList = []
+
+    def get(self):
+        """Returns None if the pool is empty"""
+
+        with self.lock:
+            ret = None
+            if len(self.tapList) > 0:
+                ret = self.tapList.pop(0)
+            if len(self.tapList) < self.lowWatermark:
+                self._scheduleRefill()
+            return ret
+
+    def _scheduleRefill(self):
+        if self.refillHandler is None:
+            self.refillHandler = GLib.idle_add(self._refill)
+
+    def _refill(self):
+        with self.lock:
+            if self.refillHandler is None:
+                return False            # released
+
+            # create one tap interface in each iteration, so that the main loop is not blocked for long
+            if len(self.tapList) < self.highWatermark:
+                try:
+                    self.tapList.append(_createBridgedTap(self.netObj, VirtTapOptions()))
+                except Exception:
+                    # the pool is only an optimization, tap interface will be created on demand
+                    self.refillHandler = None
+                    return False
+
+            if len(self.tapList) >= self.highWatermark:
+                self.refillHandler = None
+                return False
+            return True
 
 
 class _NetworkRoute(_NetworkBase, VirtHostNetworkEventCallback):
 
     def __init__(self, param, uid, nid):
+        _initSubsystems(param, ["dhcpServer", "hostNetwork"])
         super(_NetworkRoute, self).__init__(param, uid, nid)
 
         self.brname = "vnb%d" % (self.nid)
-        self.param.dhcpServer.startOnNetwork(self)
-        self.param.sambaServer.startOnNetwork(uid, self)
-        self.param.hostNetwork.registerEventCallback(self)
+        self.sambaStarted = False
+
+        dhcpStarted = False
+        try:
+            self.param.dhcpServer.startOnNetwork(self)
+            dhcpStarted = True
+            self.param.hostNetwork.registerEventCallback(self)
+        except:
+            if dhcpStarted:
+                self.param.dhcpServer.stopOnNetwork(self)
+            super(_NetworkRoute, self).release()
+            raise
 
     def release(self):
         self.param.hostNetwork.unregisterEventCallback(self)
-        self.param.sambaServer.stopOnNetwork(self)
+        if self.sambaStarted:
+            self.param.sambaServer.stopOnNetwork(self)
         self.param.dhcpServer.stopOnNetwork(self)
         super(_NetworkRoute, self).release()
 
+    def startSambaServer(self):
+        if not self.sambaStarted:
+            self.param.sambaServer.startOnNetwork(self.uid, self)
+            self.sambaStarted = True
+        return True
+
     def onActiveInterfaceAdd(self, ifName):
         assert False
 
@@ -340,27 +613,48 @@ class _NetworkIsolate(_NetworkBase):
         super(_NetworkIsolate, self).__init__(param, uid, nid)
         self.brname = "vnb%d" % (self.nid)                # it's a virtual bridge interface
         self.tapDict = dict()
+        self.tapOptionsDict = dict()
+        self.tapIdAllocator = _newTapIdAllocator(self.param, self.brname)
 
     def release(self):
         super(_NetworkIsolate, self).release()
 
-    def addTapIntf(self, param, sid):
+    def addTapIntf(self, sid, options):
         assert sid not in self.tapDict
 
-        tapname = "%s.%d" % (self.brname, VirtUtil.getMaxTapId(self.brname) + 1)
-        VirtUtil.shell('/bin/ip tuntap add dev "%s" mode tap' % (tapname))
+        tapname = "%s.%d" % (self.brname, self.tapIdAllocator.alloc())
+        try:
+            _addTap(self, tapname, options)
+        except:
+            self.tapIdAllocator.free(_getTapId(tapname))
+            raise
         self.tapDict[sid] = tapname
+        self.tapOptionsDict[sid] = options
+
+    def adoptTapIntf(self, sid, tapname, options):
+        assert sid not in self.tapDict
+
+        self.tapIdAllocator.markUsed(_getTapId(tapname))
+        if self.param.netlink.linkLookup(tapname) is None:
+            _addTap(self, tapname, options)
+        self.tapDict[sid] = tapname
+        self.tapOptionsDict[sid] = options
 
     def removeTapIntf(self, sid):
         assert sid in self.tapDict
 
         tapname = self.tapDict[sid]
-        VirtUtil.shell('/bin/ip tuntap del dev "%s" mode tap' % (tapname))
+        self.param.netlink.delTap(tapname)
+        self.tapIdAllocator.free(_getTapId(tapname))
         del self.tapDict[sid]
+        del self.tapOptionsDict[sid]
 
     def getTapInterface(self, sid):
         return self.tapDict.get(sid, None)
 
+    def getTapInterfaceOptions(self, sid):
+        return self.tapOptionsDict.get(sid, None)
+
 
 def _validateNetworkName(networkName):
     return networkName in ["bridge", "nat", "route", "isolate"]
@@ -368,3 +662,87 @@ def _validateNetworkName(networkName):
 
 def _validateResSetId(sid):
     return 1 <= sid <= 128
+
+
+def _initSubsystems(param, nameList):
+    # the subsystems are initialized before the network creates anything, so nothing is left behind
+    # if one of them raises VirtInitializationError
+    for name in nameList:
+        getattr(param, name)
+
+
+def _getNidByIp(ip):
+    # "10.1.2.12" -> 258
+    items = ip.split(".")
+    return int(items[1]) * 256 + int(items[2])
+
+
+def _newTapIdAllocator(param, brname):
+    # tap interfaces left over by others may exist, scan once so that the allocator never collides with them
+    ret = VirtIdAllocator()
+    for ifname in list(param.netlink.ifindexDict.keys()):
+        m = re.fullmatch("%s\\.([0-9]+)" % (re.escape(brname)), ifname)
+        if m is not None and int(m.group(1)) > 0:
+            ret.markUsed(int(m.group(1)))
+    return ret
+
+
+def _newTapPool(netObj):
+    if netObj.param.tapPoolHighWatermark <= 0:
+        return None
+    return _TapPool(netObj, netObj.param.tapPoolLowWatermark, netObj.param.tapPoolHighWatermark)
+
+
+def _addTap(netObj, tapname, options):
+    netObj.param.netlink.addTap(tapname, netObj.uid, pwd.getpwuid(netObj.uid).pw_gid,
+                                options.queues > 1, options.vnetHdr, options.offloads)
+
+
+def _createBridgedTap(netObj, options):
+    tapname = "%s.%d" % (netObj.brname, netObj.tapIdAllocator.alloc())
+    try:
+        _addTap(netObj, tapname, options)
+        VirtUtil.addInterfaceToBridge(netObj.brname, tapname)
+        netObj.param.netlink.setLinkUp(tapname)
+        return tapname
+    except:
+        if netObj.param.netlink.linkLookup(tapname) is not None:
+            netObj.param.netlink.delTap(tapname)
+        netObj.tapIdAllocator.free(_getTapId(tapname))
+        raise
+
+
+def _adoptBridgedTap(netObj, tapname, options):
+    netObj.tapIdAllocator.markUsed(_getTapId(tapname))
+    if netObj.param.netlink.linkLookup(tapname) is not None:
+        return
+
+    # the tap interface has gone, re-create it with the same name, so that it matches the journal
+    _addTap(netObj, tapname, options)
+    VirtUtil.addInterfaceToBridge(netObj.brname, tapname)
+    netObj.param.netlink.setLinkUp(tapname)
+
+
+def _adoptBridge(netObj, adopt):
+    """Returns True if the bridge created by the previous daemon instance is adopted"""
+    return adopt and netObj.param.netlink.linkLookup(netObj.brname) is not None
+
+
+def _getBridgeMaster(ifname):
+    try:
+        return os.path.basename(os.readlink("/sys/class/net/%s/master" % (ifname)))
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+
+def _deleteBridgedTap(netObj, tapname):
+    netObj.param.netlink.setLinkDown(tapname)
+    VirtUtil.removeInterfaceFromBridge(netObj.brname, tapname)
+    netObj.param.netlink.delTap(tapname)
+    netObj.tapIdAllocator.free(_getTapId(tapname))
+
+
+def _getTapId(tapname):
+    return int(tapname.split(".")[-1])
@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import json
+import threading
+from virt_util import VirtUtil
+from virt_param import VirtInitializationError
+
+try:
+    import nftables
+except ImportError:
+    nftables = None
+
+
+class VirtNftables:
+
+    """Applies nftables commands as atomic batches, using the JSON API of libnftables.
+       "/sbin/nft -j" is used when the python binding of libnftables is not available,
+       it costs one process spawn, but it is still one kernel transaction per batch."""
+
+    def __init__(self):
+        self.natTable = "virt-service-nat"
+        self.natSet = "nat-subnets"
+        self.natSubnetSet = set()                # { "netip/prefixlen" }
+        self.lock = threading.Lock()
+
+        self.nft = None
+        if nftables is not None:
+            self.nft = nftables.Nftables()
+            self.nft.set_json_output(True)
+        elif not os.path.exists("/sbin/nft"):
+            raise VirtInitializationError("neither libnftables python binding nor /sbin/nft is found")
+
+    def release(self):
+        assert len(self.natSubnetSet) == 0
+
+    def transaction(self, cmdList):
+        """Applies all the commands in one transaction, returns the output objects"""
+
+        if self.nft is not None:
+            rc, out, err = self.nft.json_cmd({"nftables": cmdList})
+            if rc != 0:
+                raise Exception("nftables transaction failed, %s" % (err))
+        else:
+            out = VirtUtil.shellInteractive("/sbin/nft -j -f /dev/stdin", json.dumps({"nftables": cmdList}), "stdout")
+            out = json.loads(out) if out.strip() != "" else None
+
+        if not out:
+            return []
+        return out["nftables"]
+
+    def natAddNetwork(self, netip, prefixlen):
+        with self.lock:
+            self._natAddNetworks([(netip, prefixlen)])
+
+    def natAddNetworks(self, netList):
+        """netList is [(netip, prefixlen)], all the subnets are added in one transaction"""
+
+        with self.lock:
+            self._natAddNetworks(netList)
+
+    def natRemoveNetwork(self, netip, prefixlen):
+        with self.lock:
+            self._natRemoveNetwork(netip, prefixlen)
+
+    def natRemoveStale(self):
+        """Deletes the nat table left behind by a crashed daemon instance, it is looked up in one ruleset dump"""
+
+        assert len(self.natSubnetSet) == 0
+        for obj in self.transaction([{"list": {"ruleset": None}}]):
+            if "table" in obj and obj["table"]["family"] == "ip" and obj["table"]["name"] == self.natTable:
+                self.transaction([{"delete": {"table": {"family": "ip", "name": self.natTable}}}])
+                break
+
+    def _natAddNetworks(self, netList):
+        keyList = ["%s/%d" % (netip, prefixlen) for netip, prefixlen in netList]
+        assert len(keyList) > 0 and len(set(keyList)) == len(keyList)
+        assert all(x not in self.natSubnetSet for x in keyList)
+
+        cmdList = []
+        if len(self.natSubnetSet) == 0:
+            # create table, chains, subnet set and the masquerade rule
+            # adding an existing table is not an error, the flush operations clear the objects left over by others
+            cmdList += [
+                {"add": {"table": {"family": "ip", "name": self.natTable}}},
+                {"flush": {"table": {"family": "ip", "name": self.natTable}}},
+                {"add": {"chain": self._natChain("prerouting")}},
+                {"add": {"chain": self._natChain("postrouting")}},
+                {"add": {"set": {"family": "ip", "table": self.natTable, "name": self.natSet, "type": "ipv4_addr", "flags": ["interval"]}}},
+                {"flush": {"set": {"family": "ip", "table": self.natTable, "name": self.natSet}}},
+                {"add": {"rule": {
+                    "family": "ip",
+                    "table": self.natTable,
+                    "chain": "postrouting",
+                    "expr": [
+                        {"match": {
+                            "op": "==",
+                            "left": {"payload": {"protocol": "ip", "field": "saddr"}},
+                            "right": "@%s" % (self.natSet),
+                        }},
+                        {"masquerade": None},
+                    ],
+                }}},
+            ]
+        cmdList.append({"add": {"element": self._natElement(netList)}})
+
+        self.transaction(cmdList)
+        self.natSubnetSet.update(keyList)
+
+    def _natRemoveNetwork(self, netip, prefixlen):
+        key = "%s/%d" % (netip, prefixlen)
+        assert key in self.natSubnetSet
+
+        if len(self.natSubnetSet) > 1:
+            cmd = {"delete": {"element": self._natElement([(netip, prefixlen)])}}
+        else:
+            # deleting the table deletes all its chains, sets and rules
+            cmd = {"delete": {"table": {"family": "ip", "name": self.natTable}}}
+        self.transaction([cmd])
+
+        self.natSubnetSet.remove(key)
+
+    def _natChain(self, hook):
+        return {
+            "family": "ip",
+            "table": self.natTable,
+            "name": hook,
+            "type": "nat",
+            "hook": hook,
+            "prio": 0,
+            "policy": "accept",
+        }
+
+    def _natElement(self, netList):
+        return {
+            "family": "ip",
+            "table": self.natTable,
+            "name": self.natSet,
+            "elem": [{"prefix": {"addr": netip, "len": prefixlen}} for netip, prefixlen in netList],
+        }
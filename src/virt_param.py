@@ -1,7 +1,9 @@
 #!/usr/bin/python3
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
+import os
 import tempfile
+import threading
 
 
 class VirtParam:
@@ -10,29 +12,122 @@ class VirtParam:
          /tmp/virt-service
           |----1000                             user directory
                 |----0                          network directory
-                     |----samba
+                     |----samba                 directory of the per-network smbd, see VirtSambaServer
                            |----smb.conf        samba configuration file
-                           |----smb.log         samba log file"""
+                           |----smb.log         samba log file
+                           |----hosts.d         per-host configuration files
+                           |----private         passdb and other private files
+                     |----virtiofs
+                           |----1               socket directory of resource set 1, only accessible by the user
+                                 |----abc.sock  vhost-user socket of virtiofs share abc
+          |----dnsmasq                          directory of the shared dnsmasq
+                |----dnsmasq.conf
+                |----hosts                      dhcp-hostsfile directory, one file for each network
+                |----opts                       dhcp-optsfile directory, one file for each network
+                |----dnsmasq.leases             dhcp-leasefile, monitored by VirtDhcpServer
+
+       Runtime directory structure, it survives daemon restart:
+         /run/virt-service
+          |----journal                          state journal, see VirtJournal
+          |----dnsmasq.vnb1.pid                 pid file of the dnsmasq process serving network vnb1
+          |----dnsmasq.shared.pid               pid file of the shared dnsmasq process
+          |----smbd.vnb1.pid                    pid file of the smbd process serving network vnb1"""
 
     def __init__(self):
         self.tmpDir = tempfile.mkdtemp(prefix="virt-service.")
+        self.runDir = "/run/virt-service"
+        self.journalFile = os.path.join(self.runDir, "journal")
 
         self.ctrlPort = 2207
 
         self.mainloop = None
-        self.hostNetwork = None
+        self.workerPool = None
+        self.journal = None
+        self.netlink = None
+        self.nftables = None
         self.netManager = None
         self.vfioDevManager = None
-        self.dhcpServer = None
-        self.sambaServer = None
+        self.dbusMainObject = None                  # notified of the events happened in subsystems
+
+        # hostNetwork, dhcpServer, sambaServer and virtiofsServer are created on first use, see setLazySubsystem()
+        self.lazySubsystemDict = dict()
 
         self.initError = None
 
         self.timeout = 60
         self.timeoutHandler = None
 
+        # slow operations requested by dbus clients run in worker threads
+        self.workerCount = 8
+
+        # "auto", "rtnetlink" or "networkmanager", see VirtHostNetwork
+        self.hostNetworkBackend = "auto"
+        self.hostNetworkDebounceTime = 200          # in milliseconds, 0 disables debouncing
+
+        # "per-network" or "shared", see VirtDhcpServer
+        self.dhcpServerMode = "per-network"
+
+        # "host" or "per-network", see VirtSambaServer
+        self.sambaServerMode = "host"
+
+        # in milliseconds, changed samba configuration files are written in one batch, see VirtSambaServer
+        self.sambaCfgDebounceTime = 50
+
+        # pre-created tap interfaces for each bridge/nat network, high watermark 0 disables the pool
+        self.tapPoolLowWatermark = 0
+        self.tapPoolHighWatermark = 0
+
+    @property
+    def hostNetwork(self):
+        return self._getLazySubsystem("hostNetwork")
+
+    @property
+    def dhcpServer(self):
+        return self._getLazySubsystem("dhcpServer")
+
+    @property
+    def sambaServer(self):
+        return self._getLazySubsystem("sambaServer")
+
+    @property
+    def virtiofsServer(self):
+        return self._getLazySubsystem("virtiofsServer")
+
+    def setLazySubsystem(self, name, factory):
+        """Subsystem self.<name> is created by factory() when it is accessed the first time.
+           If the creation fails, VirtInitializationError is raised to all its users, other subsystems are not affected."""
+
+        self.lazySubsystemDict[name] = _LazySubsystem(factory)
+
+    def isInitialized(self, name):
+        """Returns True if the subsystem has been created, it is used to skip subsystems that are never used"""
+
+        return self.lazySubsystemDict[name].obj is not None
+
+    def _getLazySubsystem(self, name):
+        ls = self.lazySubsystemDict[name]
+        with ls.lock:
+            if ls.obj is None and ls.error is None:
+                try:
+                    ls.obj = ls.factory()
+                except VirtInitializationError as e:
+                    ls.error = e.message
+            if ls.error is not None:
+                raise VirtInitializationError(ls.error)
+            return ls.obj
+
 
 class VirtInitializationError(Exception):
 
     def __init__(self, message):
+        super(VirtInitializationError, self).__init__(message)
         self.message = message
+
+
+class _LazySubsystem:
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.obj = None
+        self.error = None
+        self.lock = threading.Lock()          # subsystems are accessed in worker threads
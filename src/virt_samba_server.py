@@ -3,22 +3,41 @@
 
 import os
 import re
+import sys
 import pwd
 import grp
-# import signal
-import ipaddress
+import time
+import signal
+import threading
+import subprocess
 import configparser
+from gi.repository import GLib
 from virt_util import VirtUtil
 from virt_param import VirtInitializationError
 
 
 class VirtSambaServer:
 
+    """param.sambaServerMode selects which samba server serves the shares:
+         host:         the main samba server of the host, through the per-host configuration files in /etc/samba/hosts.d
+         per-network:  one smbd for each network, it listens only on the bridge address, and has its own configuration,
+                       passdb and per-host configuration files in the network temp directory
+       Changed files are collected in a window of param.sambaCfgDebounceTime milliseconds, then they are written
+       atomically in a worker thread and smbd is told to reload once for the whole batch. The callers which changed
+       the shares are notified in main loop after their batch has been applied, or has failed."""
+
     def __init__(self, param):
         self.param = param
-        self.netList = []
+        self.netDict = dict()                 # { netPrefix: uid }, every network is a /24, its prefix is "10.x.y"
+        self.serverObjDict = dict()           # { netPrefix: serverObj }, per-network mode only
         self.uidDict = dict()
         self.shareDict = dict()
+        self.lock = threading.Lock()
+
+        self.dirtySet = set()                  # vmIp of the configuration files to be written
+        self.callbackList = []                 # [(ret, doneFunc, errorFunc)] of the callers waiting for the batch
+        self.flushHandler = None
+        self.flushLock = threading.Lock()      # batches are written in order
 
         if not os.path.exists("/usr/sbin/smbd"):
             raise VirtInitializationError("/usr/sbin/smbd not found")
@@ -26,6 +45,127 @@ class VirtSambaServer:
         if not os.path.exists("/usr/bin/pdbedit"):
             raise VirtInitializationError("/usr/bin/pdbedit not found")
 
+        if self.param.sambaServerMode == "host":
+            self._checkMainServer()
+        elif self.param.sambaServerMode == "per-network":
+            if VirtUtil.getPidBySocket("0.0.0.0:445") != -1 or VirtUtil.getPidBySocket("[::]:445") != -1:
+                raise VirtInitializationError("main samba server listens on all the addresses, per-network samba servers can't listen on the bridges")
+        else:
+            assert False
+
+    def release(self):
+        assert len(self.uidDict) == 0
+        assert len(self.shareDict) == 0
+
+        # the main loop has stopped, write the pending batch now
+        with self.lock:
+            if self.flushHandler is not None:
+                GLib.source_remove(self.flushHandler)
+                self.flushHandler = None
+        self._flush()
+
+    @staticmethod
+    def removeStaleObjects(param):
+        """Removes the per-host configuration files and stops the per-network smbd processes left behind by crashed daemon instances,
+           called once at startup before restore(). The subsystem needs not to be initialized."""
+
+        # per-network smbd is re-created when the network is restored, its configuration is in the old temp directory
+        if os.path.isdir(param.runDir):
+            for fn in os.listdir(param.runDir):
+                if re.fullmatch("smbd\\..*\\.pid", fn) is not None:
+                    VirtUtil.killProcessByPidFile(os.path.join(param.runDir, fn), "smbd")
+
+        # only the files of virt-machine addresses which carry our marker are removed, others belong to the administrator
+        if not os.path.isdir("/etc/samba/hosts.d"):
+            return
+        vmIpSet = set(x["vmip"] for x in param.journal.getList("share"))
+        for fn in os.listdir("/etc/samba/hosts.d"):
+            m = re.fullmatch("(\\.)?(10\\.[0-9]+\\.[0-9]+\\.[0-9]+)\\.conf(\\.tmp)?", fn)
+            if m is None or not _isVmIp(m.group(2)):
+                continue
+            if m.group(1) is None and m.group(2) in vmIpSet:
+                continue                                                # temp files are removed too
+            fullfn = os.path.join("/etc/samba/hosts.d", fn)
+            try:
+                if not VirtUtil.readFile(fullfn).startswith(_cfgFileMarker):
+                    continue
+            except (OSError, UnicodeDecodeError):
+                continue
+            os.remove(fullfn)
+
+    def restore(self):
+        """Restores the shares recorded in the journal by the previous daemon instance, called after the networks are restored,
+           which have started samba on the networks that have shares"""
+
+        with self.lock:
+            for record in self.param.journal.getList("share"):
+                vmIp = record["vmip"]
+                if _getNetPrefix(vmIp) not in self.netDict:
+                    # the network is not restored, the share is dropped and its configuration file is deleted
+                    self.param.journal.remove("share", vmip=vmIp, name=record["name"])
+                    self.dirtySet.add(vmIp)
+                    continue
+                self.uidDict[vmIp] = record["uid"]
+                self.shareDict.setdefault(vmIp, []).append(_ShareInfo(record["name"], record["path"], record["readonly"]))
+            self.dirtySet.update(self.shareDict.keys())
+
+        # main loop is not running yet, so the files are written at once
+        self._flush()
+
+    def startOnNetwork(self, uid, netObj):
+        assert netObj.netip.endswith(".0")
+        assert netObj.netmask == "255.255.255.0"
+
+        serverObj = None
+        if self.param.sambaServerMode == "per-network":
+            serverObj = _ServerLocal(self, netObj)          # it takes a while, so self.lock is not held
+
+        with self.lock:
+            self.netDict[_getNetPrefix(netObj.netip)] = uid
+            if serverObj is not None:
+                self.serverObjDict[_getNetPrefix(netObj.netip)] = serverObj
+
+    def stopOnNetwork(self, netObj):
+        with self.flushLock:                                # no file of this network is being written
+            with self.lock:
+                self.netDict.pop(_getNetPrefix(netObj.netip), None)
+                serverObj = self.serverObjDict.pop(_getNetPrefix(netObj.netip), None)
+        if serverObj is not None:
+            serverObj.release()
+
+    def networkAddShare(self, vmIp, uid, shareName, srcPath, readonly, doneFunc, errorFunc):
+        """doneFunc(ret) or errorFunc(exception) is called in main loop after the configuration is applied, ret is the result code"""
+
+        with self.lock:
+            ret = self._networkAddShares(vmIp, uid, [(shareName, srcPath, readonly)])
+            self._addCallback(ret, lambda x: doneFunc(x[0]), errorFunc)
+
+    def networkAddShares(self, vmIp, uid, shareList, doneFunc, errorFunc):
+        """shareList is [(shareName, srcPath, readonly)], all the shares are applied in one configuration update,
+           doneFunc(ret) or errorFunc(exception) is called in main loop after that, ret is a result code for each share"""
+
+        with self.lock:
+            ret = self._networkAddShares(vmIp, uid, shareList)
+            self._addCallback(ret, doneFunc, errorFunc)
+
+    def networkRemoveShare(self, vmIp, shareName, doneFunc, errorFunc):
+        with self.lock:
+            ret = self._networkRemoveShares(vmIp, [shareName])
+            self._addCallback(ret, lambda x: doneFunc(x[0]), errorFunc)
+
+    def networkRemoveShares(self, vmIp, shareNameList, doneFunc, errorFunc):
+        """All the shares are removed in one configuration update, doneFunc(ret) or errorFunc(exception) is called
+           in main loop after that, ret is a result code for each share"""
+
+        with self.lock:
+            ret = self._networkRemoveShares(vmIp, shareNameList)
+            self._addCallback(ret, doneFunc, errorFunc)
+
+    def networkRemoveShareAll(self, vmIp):
+        with self.lock:
+            self._networkRemoveShareAll(vmIp)
+
+    def _checkMainServer(self):
         if VirtUtil.getPidBySocket("0.0.0.0:139") == -1:
             raise VirtInitializationError("no samba server running")
 
@@ -60,107 +200,241 @@ class VirtSambaServer:
         if m is None:
             raise VirtInitializationError("main samba server must have user \"nobody\"")
 
-    def release(self):
-        assert len(self.uidDict) == 0
-        assert len(self.shareDict) == 0
-
-    def startOnNetwork(self, uid, netObj):
-        self.netList.append(_NetworkInfo(netObj.netip, netObj.netmask, uid))
+    def _networkAddShares(self, vmIp, uid, shareList):
+        # result code 0: success
+        # result code 1: share already exists, or duplicates a previous one in shareList
+        # result code 2: samba is not started on the network of vmIp, nothing is applied
+        assert all("_" not in x[0] for x in shareList)
 
-    def stopOnNetwork(self, netObj):
-        try:
-            self.netList.remove(_NetworkInfo(netObj.netip, netObj.netmask, None))
-        except ValueError:
-            pass
-
-    def networkAddShare(self, vmIp, uid, shareName, srcPath, readonly):
-        # return 0: success
-        # return 1: share already exists;
-        assert "_" not in shareName
-
-        found = False
-        for n in self.netList:
-            if ipaddress.ip_address(vmIp) in ipaddress.ip_network("%s/%s" % (n.netip, n.netmask)):
-                assert uid == n.uid
-                found = True
-                break
-        assert found
+        netUid = self.netDict.get(_getNetPrefix(vmIp))
+        if netUid is None:
+            return [2] * len(shareList)
+        assert netUid == uid
 
-        if vmIp not in self.shareDict:
-            self.uidDict[vmIp] = uid
-            self.shareDict[vmIp] = [_ShareInfo(shareName, srcPath, readonly)]
-        else:
+        if vmIp in self.shareDict:
             assert self.uidDict[vmIp] == uid
-            si = _ShareInfo(shareName, srcPath, readonly)
-            if si in self.shareDict[vmIp]:
-                return 1
-            self.shareDict[vmIp].append(si)
-
-        self._updateSambaCfg(vmIp)
-        return 0
-
-    def networkRemoveShare(self, vmIp, shareName):
-        try:
-            si = _ShareInfo(shareName, None, None)
-            self.shareDict.get(vmIp, []).remove(si)
-        except ValueError:
-            pass
+        siList = self.shareDict.get(vmIp, [])
 
-        if len(self.shareDict[vmIp]) == 0:
+        ret = []
+        for shareName, srcPath, readonly in shareList:
+            si = _ShareInfo(shareName, srcPath, readonly)
+            if si in siList:
+                ret.append(1)
+                continue
+            siList.append(si)
+            self.param.journal.add("share", vmip=vmIp, name=shareName, uid=uid, path=srcPath, readonly=bool(readonly))
+            ret.append(0)
+
+        if len(siList) > 0 and vmIp not in self.shareDict:
+            self.uidDict[vmIp] = uid
+            self.shareDict[vmIp] = siList
+        if 0 in ret:
+            self._updateSambaCfg(vmIp)
+        return ret
+
+    def _networkRemoveShares(self, vmIp, shareNameList):
+        # result code 0: success
+        # result code 1: share does not exist
+        ret = []
+        for shareName in shareNameList:
+            try:
+                self.shareDict.get(vmIp, []).remove(_ShareInfo(shareName, None, None))
+            except ValueError:
+                ret.append(1)
+                continue
+            self.param.journal.remove("share", vmip=vmIp, name=shareName)
+            ret.append(0)
+
+        if vmIp in self.shareDict and len(self.shareDict[vmIp]) == 0:
             del self.shareDict[vmIp]
             del self.uidDict[vmIp]
+        if 0 in ret:
+            self._updateSambaCfg(vmIp)
+        return ret
 
-        self._updateSambaCfg(vmIp)
-
-    def networkRemoveShareAll(self, vmIp):
-        if vmIp in self.shareDict:
-            del self.shareDict[vmIp]
-            del self.uidDict[vmIp]
+    def _networkRemoveShareAll(self, vmIp):
+        if vmIp not in self.shareDict:
+            return                              # most virt-machines have no share, smbd needs no reload
+        for si in self.shareDict[vmIp]:
+            self.param.journal.remove("share", vmip=vmIp, name=si.shareName)
+        del self.shareDict[vmIp]
+        del self.uidDict[vmIp]
         self._updateSambaCfg(vmIp)
 
     def _updateSambaCfg(self, vmIp):
-        cfgfile = "/etc/samba/hosts.d/%s.conf" % (vmIp)
+        # called with self.lock held, the file is written later together with the others changed in the window
+        self.dirtySet.add(vmIp)
+        if self.flushHandler is None:
+            self.flushHandler = GLib.timeout_add(self.param.sambaCfgDebounceTime, self._onFlushTimeout)
+
+    def _addCallback(self, ret, doneFunc, errorFunc):
+        # called with self.lock held, result code 0 means the share is changed, the caller waits for the pending batch
+        if 0 in ret:
+            self.callbackList.append((ret, doneFunc, errorFunc))
+        else:
+            GLib.idle_add(_callInMainLoop, doneFunc, ret)
 
-        if vmIp not in self.shareDict:
-            if os.path.exists(cfgfile):
+    def _onFlushTimeout(self):
+        with self.lock:
+            self.flushHandler = None
+        self.param.workerPool.submit(self._flushInWorker)
+        return False
+
+    def _flushInWorker(self):
+        try:
+            self._flush()
+        except Exception as e:
+            # the callers have got the error, it is logged for the changes that have no caller, like networkRemoveShareAll()
+            print("virt-service: failed to apply samba configuration, %s" % (e), file=sys.stderr)
+
+    def _flush(self):
+        with self.flushLock:
+            # file content is generated under self.lock, file writing and smbd reloading are done without it
+            with self.lock:
+                fileList = []                   # [(serverObj, vmIp, buf)], serverObj is None in host mode
+                for vmIp in self.dirtySet:
+                    if self.param.sambaServerMode == "host":
+                        fileList.append((None, vmIp, self._genSambaCfg(vmIp)))
+                    elif _getNetPrefix(vmIp) in self.serverObjDict:
+                        fileList.append((self.serverObjDict[_getNetPrefix(vmIp)], vmIp, self._genSambaCfg(vmIp)))
+                    else:
+                        pass                    # the network has been stopped together with its smbd
+                self.dirtySet = set()
+                callbackList = self.callbackList
+                self.callbackList = []
+
+            try:
+                self._applyFiles(fileList)
+            except Exception as e:
+                for ret, doneFunc, errorFunc in callbackList:
+                    GLib.idle_add(_callInMainLoop, errorFunc, e)
+                raise
+            for ret, doneFunc, errorFunc in callbackList:
+                GLib.idle_add(_callInMainLoop, doneFunc, ret)
+
+    def _applyFiles(self, fileList):
+        # a server is reloaded only if the batch really changed its files
+        reloadSet = set()
+        for serverObj, vmIp, buf in fileList:
+            cfgfile = "%s/%s.conf" % ("/etc/samba/hosts.d" if serverObj is None else serverObj.hostsDir, vmIp)
+            if buf is None:
+                if not os.path.exists(cfgfile):
+                    continue
                 os.remove(cfgfile)
-        else:
-            username = pwd.getpwuid(self.uidDict[vmIp]).pw_name
-            groupname = grp.getgrgid(pwd.getpwuid(self.uidDict[vmIp]).pw_gid).gr_name
-
-            buf = ""
-            for si in self.shareDict[vmIp]:
-                buf += "[%s]\n" % (si.shareName)
-                buf += "path = %s\n" % (si.srcPath)
-                buf += "guest ok = yes\n"
-                buf += "guest only = yes\n"
-                buf += "force user = %s\n" % (username)
-                buf += "force group = %s\n" % (groupname)
-                if si.readonly:
-                    buf += "writable = no\n"
-                else:
-                    buf += "writable = yes\n"
-                buf += "hosts allow = %s\n" % (vmIp)
-                buf += "\n"
-            with open(cfgfile, "w") as f:
-                f.write(buf)
-
-        # tell samba to re-read configuration
-        # os.kill(self.sambaPid, signal.SIGHUP)
-
-
-class _NetworkInfo:
-
-    def __init__(self, netip, netmask, uid):
-        self.netip = netip
-        self.netmask = netmask
-        self.uid = uid
+            else:
+                if os.path.exists(cfgfile) and VirtUtil.readFile(cfgfile) == buf:
+                    continue
+                VirtUtil.writeFileAtomic(cfgfile, buf)     # smbd never reads a half-written file
+            reloadSet.add(serverObj)
+
+        # tell samba to re-read configuration, once for each server
+        for serverObj in reloadSet:
+            if serverObj is not None:
+                serverObj.reload()
+            elif os.path.exists("/usr/bin/smbcontrol"):
+                VirtUtil.shell("/usr/bin/smbcontrol smbd reload-config")
+            else:
+                pid = VirtUtil.getPidBySocket("0.0.0.0:139")
+                if pid != -1:
+                    os.kill(pid, signal.SIGHUP)
+
+    def _genSambaCfg(self, vmIp):
+        # returns None if the configuration file should be deleted
+        if vmIp not in self.shareDict:
+            return None
+
+        username = pwd.getpwuid(self.uidDict[vmIp]).pw_name
+        groupname = grp.getgrgid(pwd.getpwuid(self.uidDict[vmIp]).pw_gid).gr_name
+
+        buf = _cfgFileMarker
+        for si in self.shareDict[vmIp]:
+            buf += "[%s]\n" % (si.shareName)
+            buf += "path = %s\n" % (si.srcPath)
+            buf += "guest ok = yes\n"
+            buf += "guest only = yes\n"
+            buf += "force user = %s\n" % (username)
+            buf += "force group = %s\n" % (groupname)
+            if si.readonly:
+                buf += "writable = no\n"
+            else:
+                buf += "writable = yes\n"
+            buf += "hosts allow = %s\n" % (vmIp)
+            buf += "\n"
+        return buf
+
+
+class _ServerLocal:
+
+    """A smbd serving one network, it listens only on the bridge address.
+       Share churn of this network never reloads the main samba server of the host or the smbd of other networks."""
+
+    def __init__(self, pObj, netObj):
+        self.param = pObj.param
+        self.netObj = netObj
+        self.dir = os.path.join(self.netObj.getTmpDir(), "samba")
+        self.confFile = os.path.join(self.dir, "smb.conf")
+        self.hostsDir = os.path.join(self.dir, "hosts.d")
+        self.pidFile = os.path.join(self.param.runDir, "smbd.%s.pid" % (self.netObj.brname))
+        self.serverProc = None
+
+        VirtUtil.killProcessByPidFile(self.pidFile, "smbd")     # smbd started by the previous daemon instance may still be running
+        VirtUtil.mkDirAndClear(self.dir)
+        for d in ["hosts.d", "private", "lock", "state", "cache"]:
+            os.mkdir(os.path.join(self.dir, d))
+        self._genSmbCfgFile()
+
+        # guest account in the passdb of this server, with empty password
+        VirtUtil.shellInteractive("/usr/bin/pdbedit -s %s -a -u nobody -t" % (self.confFile), "\n\n", "stdout")
 
-    def __eq__(self, other):
-        return self.netip == other.netip and self.netmask == other.netmask
+        try:
+            cmd = ["/usr/sbin/smbd"]
+            cmd.append("--foreground")                      # don't run as daemon, so we can control it
+            cmd.append("--no-process-group")
+            cmd.append("--configfile=%s" % (self.confFile))
+            self.serverProc = subprocess.Popen(cmd)
+            VirtUtil.writeFile(self.pidFile, "%d\n" % (self.serverProc.pid))
+            _waitServerReady(self.serverProc, self.netObj.brip)
+        except:
+            self.release()
+            raise
 
-    def __ne__(self, other):
-        return self.netip != other.netip and self.netmask == other.netmask
+    def release(self):
+        if self.serverProc is not None:
+            self.serverProc.terminate()
+            self.serverProc.wait()
+            self.serverProc = None
+        VirtUtil.forceDelete(self.pidFile)
+
+    def reload(self):
+        if os.path.exists("/usr/bin/smbcontrol"):
+            VirtUtil.shell("/usr/bin/smbcontrol -s %s smbd reload-config" % (self.confFile))
+        else:
+            self.serverProc.send_signal(signal.SIGHUP)
+
+    def _genSmbCfgFile(self):
+        buf = ""
+        buf += "[global]\n"
+        buf += "workgroup = WORKGROUP\n"
+        buf += "security = user\n"
+        buf += "map to guest = Bad User\n"
+        buf += "guest account = nobody\n"
+        buf += "passdb backend = tdbsam:%s\n" % (os.path.join(self.dir, "private", "passdb.tdb"))
+        buf += "interfaces = %s/%s\n" % (self.netObj.brip, self.netObj.netmask)
+        buf += "bind interfaces only = yes\n"               # don't listen on 0.0.0.0
+        buf += "smb ports = 445\n"
+        buf += "disable netbios = yes\n"
+        buf += "private dir = %s\n" % (os.path.join(self.dir, "private"))
+        buf += "lock directory = %s\n" % (os.path.join(self.dir, "lock"))
+        buf += "state directory = %s\n" % (os.path.join(self.dir, "state"))
+        buf += "cache directory = %s\n" % (os.path.join(self.dir, "cache"))
+        buf += "pid directory = %s\n" % (self.dir)
+        buf += "log file = %s\n" % (os.path.join(self.dir, "smb.log"))
+        buf += "max log size = 1000\n"
+        buf += "load printers = no\n"
+        buf += "printcap name = /dev/null\n"
+        buf += "disable spoolss = yes\n"
+        buf += "include = %s/%%I.conf\n" % (self.hostsDir)
+        VirtUtil.writeFile(self.confFile, buf)
 
 
 class _ShareInfo:
@@ -175,3 +449,34 @@ class _ShareInfo:
 
     def __ne__(self, other):
         return self.shareName != other.shareName
+
+
+# first line of the per-host configuration files, so that removeStaleObjects() knows the file is ours
+_cfgFileMarker = "# generated by virt-service, don't edit\n"
+
+
+def _isVmIp(ip):
+    # only the virt-machines get a configuration file, see _NetworkBase.getVmIp()
+    items = [int(x) for x in ip.split(".")]
+    return items[0] == 10 and 1 <= items[1] * 256 + items[2] <= 256 * 256 - 1 and 11 <= items[3] <= 139
+
+
+def _callInMainLoop(func, arg):
+    func(arg)
+    return False
+
+
+def _getNetPrefix(ip):
+    # "10.0.1.12" -> "10.0.1"
+    return ip.rsplit(".", 1)[0]
+
+
+def _waitServerReady(proc, addr):
+    # smbd is ready when it listens on the specified address
+    for i in range(0, 500):
+        if proc.poll() is not None:
+            raise Exception("smbd exited with code %d" % (proc.returncode))
+        if any(x[0] == addr for x in VirtUtil.getListeningSockets("tcp", 445)):
+            return
+        time.sleep(0.01)
+    raise Exception("smbd is not listening on %s" % (addr))
@@ -2,16 +2,16 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
-import netifaces
 import shutil
 import subprocess
 import time
 import grp
+import signal
 import pwd
 import socket
-import re
 import struct
 import fcntl
+import threading
 
 
 class VirtUtil:
@@ -74,6 +74,16 @@ class VirtUtil:
         if mode is not None:
             VirtUtil.shell("/bin/chmod " + mode + " \"" + filename + "\"")
 
+    @staticmethod
+    def writeFileAtomic(filename, buf):
+        """Write buffer to a temp file and rename it, readers never see a half-written file.
+           The temp file name starts with a dot, so that it is ignored by programs which read the whole directory."""
+
+        tmpFilename = os.path.join(os.path.dirname(filename), "." + os.path.basename(filename) + ".tmp")
+        with open(tmpFilename, 'w') as f:
+            f.write(buf)
+        os.rename(tmpFilename, filename)
+
     @staticmethod
     def mkDirAndClear(dirname):
         VirtUtil.forceDelete(dirname)
@@ -250,6 +260,48 @@ class VirtUtil:
         finally:
             s.close()
 
+    @staticmethod
+    def createTapInterface(ifname, uid=None, gid=None, multiQueue=False, vnetHdr=False, offloads=[]):
+        """Create a persistent tap interface through /dev/net/tun, no external program is needed.
+           offloads is a list of "csum", "tso4", "tso6", "tso_ecn", "ufo"."""
+
+        fd = os.open("/dev/net/tun", os.O_RDWR)
+        try:
+            fcntl.ioctl(fd, 0x400454ca, VirtUtil._tapIfReq(ifname, multiQueue, vnetHdr))   # TUNSETIFF
+            if len(offloads) > 0:
+                flags = 0
+                for o in offloads:
+                    flags |= _tunOffloadFlags[o]
+                fcntl.ioctl(fd, 0x400454d0, flags)                                          # TUNSETOFFLOAD
+            if uid is not None:
+                fcntl.ioctl(fd, 0x400454cc, uid)                                            # TUNSETOWNER
+            if gid is not None:
+                fcntl.ioctl(fd, 0x400454ce, gid)                                            # TUNSETGROUP
+            fcntl.ioctl(fd, 0x400454cb, 1)                                                  # TUNSETPERSIST
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def openTapQueue(ifname, multiQueue=False, vnetHdr=False):
+        """Attach a new queue to an existing tap interface, returns the file descriptor"""
+
+        fd = os.open("/dev/net/tun", os.O_RDWR)
+        try:
+            fcntl.ioctl(fd, 0x400454ca, VirtUtil._tapIfReq(ifname, multiQueue, vnetHdr))   # TUNSETIFF
+            return fd
+        except:
+            os.close(fd)
+            raise
+
+    @staticmethod
+    def _tapIfReq(ifname, multiQueue, vnetHdr):
+        flags = 0x0002 | 0x1000                     # IFF_TAP | IFF_NO_PI
+        if multiQueue:
+            flags |= 0x0100                         # IFF_MULTI_QUEUE
+        if vnetHdr:
+            flags |= 0x4000                         # IFF_VNET_HDR
+        return struct.pack("16sH", ifname.encode("ascii"), flags)
+
     @staticmethod
     def loadKernelModule(modname):
         """Loads a kernel module."""
@@ -287,27 +339,115 @@ class VirtUtil:
         return groups
 
     @staticmethod
-    def getMaxTapId(brname):
-        maxId = 0
-        for ifname in netifaces.interfaces():
-            m = re.match("%s\\.([0-9]+)" % (brname), ifname)
-            if m is not None:
-                id = int(m.group(1))
-                if id > maxId:
-                    maxId = id
-        return maxId
+    def getPidBySocket(socketInfo, portType="tcp"):
+        """need to be run by root. socketInfo is like 0.0.0.0:80 or [::]:80, returns -1 if no process listens on it"""
+
+        addr, port = socketInfo.rsplit(":", 1)
+        ipv6 = addr.startswith("[")
+        if ipv6:
+            addr = addr[1:-1]
+        for laddr, lport, uid, inode in VirtUtil.getListeningSockets(portType, int(port), ipv6):
+            if laddr == addr:
+                pid = VirtUtil.getPidBySocketInode(inode, uid)
+                if pid is not None:
+                    return pid
+        return -1
 
     @staticmethod
-    def getPidBySocket(socketInfo):
-        """need to be run by root. socketInfo is like 0.0.0.0:80"""
+    def getListeningSockets(portType, port=None, ipv6=False):
+        """Returns [(addr, port, uid, inode)] of the listening IPv4 sockets, or IPv6 sockets if ipv6 is True,
+           port=None means all ports. Sockets are dumped by NETLINK_SOCK_DIAG in kernel, no /proc/*/fd is walked."""
 
-        rc, ret = VirtUtil.shell("/bin/netstat -anp | grep \"%s\"" % (socketInfo), "retcode+stdout")
-        if rc != 0:
-            return -1
+        if portType == "tcp":
+            proto = socket.IPPROTO_TCP
+            states = 1 << 10                                              # TCP_LISTEN
+        elif portType == "udp":
+            proto = socket.IPPROTO_UDP
+            states = 1 << 7                                               # TCP_CLOSE, unconnected udp socket
+        else:
+            assert False
 
-        m = re.search(" +([0-9]+)/.*$", ret, re.MULTILINE)
-        assert m is not None
-        return int(m.group(1))
+        # struct nlmsghdr + struct inet_diag_req_v2
+        family = socket.AF_INET6 if ipv6 else socket.AF_INET
+        req = struct.pack("=BBBBI48x", family, proto, 0, 0, states)
+        req = struct.pack("=IHHII", 16 + len(req), 20, 0x301, 1, 0) + req  # SOCK_DIAG_BY_FAMILY, NLM_F_REQUEST | NLM_F_DUMP
+
+        ret = []
+        s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, 4)           # NETLINK_SOCK_DIAG
+        try:
+            s.send(req)
+            while True:
+                buf = s.recv(65536)
+                offset = 0
+                while offset < len(buf):
+                    msgLen, msgType = struct.unpack_from("=IH", buf, offset)
+                    if msgType == 3:                                        # NLMSG_DONE
+                        return ret
+                    if msgType == 2:                                        # NLMSG_ERROR
+                        errcode = -struct.unpack_from("=i", buf, offset + 16)[0]
+                        raise OSError(errcode, os.strerror(errcode))
+
+                    # struct inet_diag_msg
+                    sport, = struct.unpack_from("!H", buf, offset + 16 + 4)
+                    if ipv6:
+                        saddr = socket.inet_ntop(socket.AF_INET6, buf[offset + 16 + 8:offset + 16 + 24])
+                    else:
+                        saddr = socket.inet_ntoa(buf[offset + 16 + 8:offset + 16 + 12])
+                    uid, inode = struct.unpack_from("=II", buf, offset + 16 + 64)
+                    if port is None or sport == port:
+                        ret.append((saddr, sport, uid, inode))
+
+                    offset += (msgLen + 3) & ~3
+        finally:
+            s.close()
+
+    @staticmethod
+    def getPidBySocketInode(inode, uid=None):
+        """Returns the pid of a process which has the socket opened, returns None if not found.
+           The processes owned by uid are checked first if uid is specified, uid is the owner of the socket,
+           the process may have changed its uid or received the socket from others, so all the processes
+           are checked if none of them has it."""
+
+        ret = VirtUtil._getPidBySocketInode(inode, uid)
+        if ret is None and uid is not None:
+            ret = VirtUtil._getPidBySocketInode(inode, None)
+        return ret
+
+    @staticmethod
+    def _getPidBySocketInode(inode, uid):
+        target = "socket:[%d]" % (inode)
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            try:
+                if uid is not None and os.stat("/proc/%s" % (pid)).st_uid != uid:
+                    continue
+                fdDir = "/proc/%s/fd" % (pid)
+                for fd in os.listdir(fdDir):
+                    if os.readlink(os.path.join(fdDir, fd)) == target:
+                        return int(pid)
+            except OSError:
+                continue                                                    # process has exited
+        return None
+
+    @staticmethod
+    def killProcessByPidFile(pidFile, comm):
+        """Terminates the process recorded in pid file and waits for it to exit, then the pid file is deleted.
+           The process is left alone if its command name is not comm, the pid may have been re-used by others."""
+
+        try:
+            pid = int(VirtUtil.readFile(pidFile).strip())
+        except (OSError, ValueError):
+            return
+        try:
+            if VirtUtil.readFile("/proc/%d/comm" % (pid)).strip() == comm:
+                os.kill(pid, signal.SIGTERM)
+                for i in range(0, 100):
+                    os.kill(pid, 0)
+                    time.sleep(0.01)
+        except OSError:
+            pass                    # process has exited
+        VirtUtil.forceDelete(pidFile)
 
     @staticmethod
     def dbusGetUserId(connection, sender):
@@ -341,3 +481,73 @@ class VirtUtil:
         inStr += "%s\n" % (password)
         inStr += "%s\n" % (password)
         VirtUtil.shellInteractive("/usr/bin/pdbedit -b tdbsam:%s -a \"%s\" -t" % (filename, username), inStr)
+
+
+_tunOffloadFlags = {
+    "csum": 0x01,                                   # TUN_F_CSUM
+    "tso4": 0x02,                                   # TUN_F_TSO4
+    "tso6": 0x04,                                   # TUN_F_TSO6
+    "tso_ecn": 0x08,                                # TUN_F_TSO_ECN
+    "ufo": 0x10,                                    # TUN_F_UFO
+}
+
+
+class VirtIdAllocator:
+
+    """Allocates integer ids from [startId, endId] in O(1), freed ids are re-used first. It's thread-safe."""
+
+    def __init__(self, startId=1, endId=None):
+        self.startId = startId
+        self.endId = endId
+        self.nextId = startId           # ids not smaller than nextId have never been allocated
+        self.freeList = []              # freed ids, smaller than nextId
+        self.freeSet = set()            # same content as freeList, for O(1) membership test
+        self.lock = threading.Lock()
+
+    def alloc(self):
+        with self.lock:
+            return self._alloc()
+
+    def free(self, id):
+        with self.lock:
+            self._free(id)
+
+    def markUsed(self, id):
+        """Used for seeding the allocator with ids allocated before"""
+
+        with self.lock:
+            self._markUsed(id)
+
+    def isUsed(self, id):
+        with self.lock:
+            return self._isUsed(id)
+
+    def _alloc(self):
+        if len(self.freeList) > 0:
+            ret = self.freeList.pop()
+            self.freeSet.remove(ret)
+            return ret
+        if self.endId is not None and self.nextId > self.endId:
+            raise Exception("no free id in [%d,%d]" % (self.startId, self.endId))
+        ret = self.nextId
+        self.nextId += 1
+        return ret
+
+    def _free(self, id):
+        assert self._isUsed(id)
+        self.freeList.append(id)
+        self.freeSet.add(id)
+
+    def _markUsed(self, id):
+        assert id >= self.startId and (self.endId is None or id <= self.endId)
+        if id >= self.nextId:
+            for i in range(self.nextId, id):
+                self.freeList.append(i)
+                self.freeSet.add(i)
+            self.nextId = id + 1
+        elif id in self.freeSet:
+            self.freeList.remove(id)
+            self.freeSet.remove(id)
+
+    def _isUsed(self, id):
+        return self.startId <= id < self.nextId and id not in self.freeSet
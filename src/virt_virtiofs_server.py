@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import pwd
+import time
+import threading
+import subprocess
+from gi.repository import GLib
+from virt_param import VirtInitializationError
+
+
+class VirtVirtiofsServer:
+
+    """Runs one virtiofsd for each virtiofs share, the virt-machine connects to its vhost-user socket.
+       virtiofsd runs as the owner of the resource set, so the guest has the same access right as the user.
+       virtiofsd serves only one vhost-user connection and exits when it is closed, so it is started again
+       to let the virt-machine re-connect, unless it exits too quickly, which means it can't work at all, then the
+       share is removed. Only the rust implementation of virtiofsd is supported, the legacy one in qemu has
+       different command line options. Operations on the same resource set are serialized by the caller."""
+
+    def __init__(self, param):
+        self.param = param
+        self.shareDict = dict()            # { (uid, sid): { shareName: shareObj } }
+        self.lock = threading.Lock()       # shares are added in worker threads, virtiofsd exits are processed in main loop
+
+        self.virtiofsd = None
+        for fn in ["/usr/libexec/virtiofsd", "/usr/lib/virtiofsd", "/usr/bin/virtiofsd"]:
+            if os.path.exists(fn):
+                self.virtiofsd = fn
+                break
+        if self.virtiofsd is None:
+            raise VirtInitializationError("virtiofsd not found")
+
+        # the legacy virtiofsd uses "-o source=PATH" instead of "--shared-dir"
+        out = subprocess.run([self.virtiofsd, "--help"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True).stdout
+        if "--shared-dir" not in out:
+            raise VirtInitializationError("%s is not supported, the rust implementation of virtiofsd is needed" % (self.virtiofsd))
+
+    def release(self):
+        assert len(self.shareDict) == 0
+
+    def addShare(self, uid, sid, netTmpDir, shareName, srcPath, cacheMode, threadPoolSize):
+        """Returns the vhost-user socket path, returns None if the share already exists.
+           threadPoolSize is None means the default value of virtiofsd."""
+
+        with self.lock:
+            if shareName in self.shareDict.get((uid, sid), dict()):
+                return None
+
+        # the socket directory is only accessible by the user
+        sockDir = os.path.join(netTmpDir, "virtiofs", str(sid))
+        if not os.path.exists(sockDir):
+            os.makedirs(sockDir)
+            os.chown(sockDir, uid, pwd.getpwuid(uid).pw_gid)
+            os.chmod(sockDir, 0o700)
+
+        # it takes a while, so self.lock is not held
+        shareObj = _Share(self, uid, sid, shareName, os.path.join(sockDir, "%s.sock" % (shareName)), srcPath, cacheMode, threadPoolSize)
+
+        with self.lock:
+            if shareObj.serverProc is None:
+                # virtiofsd exited too quickly before the share is added, shareObj._onExit() doesn't start it again
+                shareObj.release()
+                raise Exception("virtiofsd exited when starting")
+            self.shareDict.setdefault((uid, sid), dict())[shareName] = shareObj
+        return shareObj.socketPath
+
+    def removeShare(self, uid, sid, shareName):
+        with self.lock:
+            self._removeShare(uid, sid, shareName)
+
+    def _removeShare(self, uid, sid, shareName):
+        shareObj = self.shareDict.get((uid, sid), dict()).pop(shareName, None)
+        if shareObj is None:
+            return
+        if len(self.shareDict[(uid, sid)]) == 0:
+            del self.shareDict[(uid, sid)]
+        shareObj.release()
+
+    def removeShareAll(self, uid, sid):
+        with self.lock:
+            for shareObj in self.shareDict.pop((uid, sid), dict()).values():
+                shareObj.release()
+
+
+class _Share:
+
+    def __init__(self, pObj, uid, sid, shareName, socketPath, srcPath, cacheMode, threadPoolSize):
+        self.pObj = pObj
+        self.uid = uid
+        self.sid = sid
+        self.shareName = shareName
+        self.socketPath = socketPath
+        self.srcPath = srcPath
+        self.cacheMode = cacheMode
+        self.threadPoolSize = threadPoolSize
+
+        self.serverProc = None
+        self.watch = None
+        self.startTime = None
+
+        try:
+            self._start()
+            self._waitReady()
+        except:
+            with self.pObj.lock:
+                self.release()
+            raise
+
+    def release(self):
+        # called with pObj.lock held, so it is not run together with self._onExit()
+        if self.watch is not None:
+            GLib.source_remove(self.watch)
+            self.watch = None
+        if self.serverProc is not None:
+            self.serverProc.terminate()
+            self.serverProc.wait()
+            self.serverProc = None
+        _removeSocket(self.socketPath)
+
+    def _start(self):
+        _removeSocket(self.socketPath)                  # virtiofsd doesn't remove it when exits
+
+        pw = pwd.getpwuid(self.uid)
+        cmd = [self.pObj.virtiofsd]
+        cmd.append("--socket-path=%s" % (self.socketPath))
+        cmd.append("--shared-dir=%s" % (self.srcPath))
+        cmd.append("--cache=%s" % (self.cacheMode))
+        cmd.append("--sandbox=none")                    # no namespace sandbox, it needs privileges that the user doesn't have
+        if self.threadPoolSize is not None:
+            cmd.append("--thread-pool-size=%d" % (self.threadPoolSize))
+        self.serverProc = subprocess.Popen(cmd, user=pw.pw_uid, group=pw.pw_gid, extra_groups=os.getgrouplist(pw.pw_name, pw.pw_gid))
+        self.watch = GLib.child_watch_add(GLib.PRIORITY_DEFAULT, self.serverProc.pid, self._onExit)
+        self.startTime = time.monotonic()
+
+    def _waitReady(self):
+        # virtiofsd creates the socket after it is initialized
+        # the process is reaped by GLib, self._onExit() clears self.serverProc when it exits
+        for i in range(0, 100):
+            if self.serverProc is None:
+                raise Exception("virtiofsd exited when starting")
+            if os.path.exists(self.socketPath):
+                return
+            time.sleep(0.01)
+        raise Exception("virtiofsd is not listening on %s" % (self.socketPath))
+
+    def _onExit(self, pid, status):
+        # called in main loop, the process has been reaped by GLib
+        with self.pObj.lock:
+            if self.watch is None:
+                return                                  # the share has been released
+            self.watch = None
+            self.serverProc = None
+
+            if time.monotonic() - self.startTime >= 1:
+                self._start()
+            elif self.pObj.shareDict.get((self.uid, self.sid), dict()).get(self.shareName) is self:
+                self.pObj._removeShare(self.uid, self.sid, self.shareName)
+
+
+def _removeSocket(path):
+    if os.path.exists(path):
+        os.remove(path)